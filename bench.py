@@ -0,0 +1,428 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import io
+import random
+from PIL import Image, ImageFilter
+
+SIZES = (1000, 10000, 100000)
+THUMB_SIZES = (1000, 10000)
+ENGINES = ("threaded", "asyncio")
+CONCURRENCY = (1, 4, 16, 64)
+DURATION = 3.0
+LATENCY_REQUESTS = 200
+STATIC_REQUESTS = 200
+RANGE_SIZE = 64 * 1024
+BIG_FILE_MB = 16
+TEMPLATES = 32
+TEMPLATE_SIZE = (600, 800)
+STARTUP_TIMEOUT = 300
+CRAWLER_POSTS = 2000
+CRAWLER_JOBS = 2
+CRAWLER_LATENCY = 0.02
+CRAWLER_FILE_KB = 64
+CRAWLER_THROTTLE_EVERY = 200
+CRAWLER_THROTTLE_FOR = 10
+OUTPUT = "bench_results.json"
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def summarize(latencies):
+    if not latencies:
+        return {"count": 0}
+    values = sorted(latencies)
+    def pick(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 3)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "min_ms": round(values[0] * 1000, 3),
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(values[-1] * 1000, 3)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def make_templates(count=TEMPLATES):
+    rng = random.Random(0)
+    templates = []
+    for i in range(count):
+        small = Image.new('RGB', (12, 16))
+        small.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(12 * 16)])
+        img = small.resize(TEMPLATE_SIZE, Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(4))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        templates.append(buf.getvalue())
+    return templates
+
+def build_library(lib_dir, size, templates):
+    import server
+    image_dir = os.path.join(lib_dir, server.IMAGE_FOLDER)
+    os.makedirs(image_dir, exist_ok=True)
+    template_paths = []
+    for i, data in enumerate(templates):
+        path = os.path.join(lib_dir, f"template-{i}.jpg")
+        with open(path, 'wb') as f:
+            f.write(data)
+        template_paths.append(path)
+
+    started = time.perf_counter()
+    for i in range(1, size + 1):
+        path = os.path.join(image_dir, f"{i}.jpg")
+        if os.path.exists(path):
+            continue
+        try:
+            os.link(template_paths[i % len(template_paths)], path)
+        except OSError:
+            shutil.copyfile(template_paths[i % len(template_paths)], path)
+    return time.perf_counter() - started
+
+def add_big_file(lib_dir):
+    import server
+    path = os.path.join(lib_dir, server.IMAGE_FOLDER, "big.webm")
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(os.urandom(BIG_FILE_MB * 1024 * 1024))
+    return f"/{server.IMAGE_FOLDER}/big.webm"
+
+def time_thumbs(lib_dir):
+    import server
+    cwd = os.getcwd()
+    os.chdir(lib_dir)
+    try:
+        shutil.rmtree(server.THUMB_FOLDER, ignore_errors=True)
+        for path in (server.THUMB_MANIFEST, server.THUMB_META, server.THUMB_SYNC_STATE):
+            if os.path.exists(path):
+                os.remove(path)
+        started = time.perf_counter()
+        generated = server.generate_thumbs()
+        cold = time.perf_counter() - started
+        started = time.perf_counter()
+        server.generate_thumbs()
+        warm = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+    return {"generated": generated, "workers": server.THUMB_WORKERS, "cold_s": round(cold, 3),
+            "warm_s": round(warm, 3), "cold_per_s": round(generated / cold, 1) if cold else None}
+
+def serve(lib_dir, port, engine):
+    import asyncio
+    import server
+    os.chdir(lib_dir)
+    server.CATALOG.refresh()
+    if engine == "asyncio":
+        asyncio.run(server.serve_async("127.0.0.1", port))
+    else:
+        with server.ThreadedTCPServer(("127.0.0.1", port), server.CustomHandler) as httpd:
+            httpd.serve_forever()
+
+class ServerProcess:
+    def __init__(self, lib_dir, engine):
+        self.lib_dir = lib_dir
+        self.engine = engine
+        self.port = free_port()
+        self.process = None
+        self.startup_s = None
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", self.lib_dir,
+                                         "--port", str(self.port), "--engine", self.engine],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while time.perf_counter() - started < STARTUP_TIMEOUT:
+            conn = self.connect()
+            try:
+                status, _, _ = request(conn, "/api/stats")
+                conn.close()
+                if status == 200:
+                    self.startup_s = time.perf_counter() - started
+                    return self
+            except OSError:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"server exited with code {self.process.returncode}")
+                time.sleep(0.05)
+        raise RuntimeError(f"server did not start within {STARTUP_TIMEOUT} s")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        return False
+
+    def connect(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+
+def request(conn, path, headers=None):
+    conn.request("GET", path, headers=headers or {})
+    resp = conn.getresponse()
+    body = resp.read()
+    return resp.status, resp.getheaders(), body
+
+def timed_requests(srv, paths, headers=None):
+    conn = srv.connect()
+    latencies = []
+    transferred = 0
+    started = time.perf_counter()
+    for path in paths:
+        t = time.perf_counter()
+        status, _, body = request(conn, path, headers)
+        latencies.append(time.perf_counter() - t)
+        if status >= 400:
+            raise RuntimeError(f"GET {path} -> {status}")
+        transferred += len(body)
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return latencies, transferred, elapsed
+
+def bench_listing(srv, pages):
+    result = {}
+    for label, page in (("shallow", 1), ("deep", pages)):
+        first, _, _ = timed_requests(srv, [f"/api/images?page={page}"])
+        warm, _, _ = timed_requests(srv, [f"/api/images?page={page}"] * LATENCY_REQUESTS)
+        result[label] = {"page": page, "first_ms": round(first[0] * 1000, 3), "warm": summarize(warm)}
+
+    rng = random.Random(1)
+    spread = [f"/api/images?page={rng.randint(1, pages)}" for _ in range(LATENCY_REQUESTS)]
+    latencies, _, _ = timed_requests(srv, spread)
+    result["random_pages"] = summarize(latencies)
+    return result
+
+def bench_static(srv, size, big_path):
+    import server
+    rng = random.Random(2)
+    paths = [f"/{server.IMAGE_FOLDER}/{rng.randint(1, size)}.jpg" for _ in range(STATIC_REQUESTS)]
+    latencies, transferred, elapsed = timed_requests(srv, paths)
+    result = {"small_files": dict(summarize(latencies), mb_per_s=round(transferred / elapsed / 1024 / 1024, 2),
+                                  req_per_s=round(len(paths) / elapsed, 1))}
+
+    latencies, transferred, elapsed = timed_requests(srv, [big_path] * 5)
+    result["big_file"] = dict(summarize(latencies), mb_per_s=round(transferred / elapsed / 1024 / 1024, 2))
+
+    big_size = BIG_FILE_MB * 1024 * 1024
+    offsets = [rng.randrange(0, big_size - RANGE_SIZE) for _ in range(STATIC_REQUESTS)]
+    conn = srv.connect()
+    latencies = []
+    started = time.perf_counter()
+    for offset in offsets:
+        t = time.perf_counter()
+        status, _, body = request(conn, big_path, {"Range": f"bytes={offset}-{offset + RANGE_SIZE - 1}"})
+        latencies.append(time.perf_counter() - t)
+        if status != 206 or len(body) != RANGE_SIZE:
+            raise RuntimeError(f"Range request returned {status} with {len(body)} bytes")
+    elapsed = time.perf_counter() - started
+    conn.close()
+    result["range"] = dict(summarize(latencies), range_bytes=RANGE_SIZE,
+                           req_per_s=round(len(offsets) / elapsed, 1),
+                           mb_per_s=round(len(offsets) * RANGE_SIZE / elapsed / 1024 / 1024, 2))
+    return result
+
+def bench_concurrency(srv, pages, levels, duration):
+    results = []
+    for level in levels:
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def worker(seed):
+            rng = random.Random(seed)
+            local = []
+            conn = srv.connect()
+            try:
+                while time.perf_counter() < deadline:
+                    t = time.perf_counter()
+                    try:
+                        status, _, _ = request(conn, f"/api/images?page={rng.randint(1, pages)}")
+                        if status != 200:
+                            raise OSError(status)
+                    except (OSError, http.client.HTTPException):
+                        with lock:
+                            errors[0] += 1
+                        conn.close()
+                        conn = srv.connect()
+                        continue
+                    local.append(time.perf_counter() - t)
+            finally:
+                conn.close()
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(level)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        results.append(dict(summarize(latencies), connections=level, errors=errors[0],
+                            req_per_s=round(len(latencies) / elapsed, 1)))
+        print(f"   ⚡ {level} соединений: {results[-1]['req_per_s']} req/s, p99 {results[-1].get('p99_ms')} мс")
+    return results
+
+def bench_library(work_dir, size, templates, args):
+    import server
+    lib_dir = os.path.join(work_dir, f"lib-{size}")
+    print(f"📚 Библиотека {size} файлов: {lib_dir}")
+    result = {"files": size, "build_s": round(build_library(lib_dir, size, templates), 3)}
+
+    if size in args.thumb_sizes:
+        print("   🖼️ generate_thumbs: холодный и тёплый прогон")
+        result["thumbs"] = time_thumbs(lib_dir)
+
+    big_path = add_big_file(lib_dir)
+    pages = max(1, -(-(size + 1) // server.PAGE_SIZE))
+    result["engines"] = {}
+    for engine in args.engines:
+        print(f"   🌐 Сервер ({engine})")
+        with ServerProcess(lib_dir, engine) as srv:
+            result["engines"][engine] = {
+                "startup_s": round(srv.startup_s, 3),
+                "api_images": bench_listing(srv, pages),
+                "static": bench_static(srv, size, big_path),
+                "concurrency": bench_concurrency(srv, pages, args.concurrency, args.duration)
+            }
+    return result
+
+def bench_crawler(work_dir, args):
+    crawl_dir = os.path.join(work_dir, "crawler")
+    shutil.rmtree(crawl_dir, ignore_errors=True)
+    os.makedirs(crawl_dir)
+    port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(ROOT, "dapi_stub.py"), "--port", str(port),
+                             "--posts", str(args.crawler_posts), "--latency", str(args.crawler_latency),
+                             "--file-kb", str(args.crawler_file_kb),
+                             "--throttle-every", str(args.throttle_every), "--throttle-for", str(args.throttle_for),
+                             "--retry-after", "1"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cwd = os.getcwd()
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        sys.path.insert(0, ROOT)
+        import main
+        main.EMPTY_PAGES_LIMIT = 2
+        os.chdir(crawl_dir)
+        jobs = [main.CrawlJob(f"bench_tag_{i}") for i in range(args.crawler_jobs)]
+        print(f"🕷️ Краулер: {len(jobs)} заданий × {args.crawler_posts} постов через заглушку на порту {port}")
+        started = time.perf_counter()
+        with main.Crawler(f"http://127.0.0.1:{port}/index.php", stats_path=None) as crawler:
+            crawler.run(jobs)
+            elapsed = time.perf_counter() - started
+            values = dict(crawler.stats.values)
+            throttled = crawler.limiter.throttled
+    finally:
+        os.chdir(cwd)
+        stub.terminate()
+        stub.wait(timeout=10)
+
+    return {
+        "posts": args.crawler_posts,
+        "jobs": args.crawler_jobs,
+        "latency_s": args.crawler_latency,
+        "file_kb": args.crawler_file_kb,
+        "throttle": {"every": args.throttle_every, "for": args.throttle_for},
+        "elapsed_s": round(elapsed, 3),
+        "downloaded": sum(job.downloaded for job in jobs),
+        "failed": sum(job.failed for job in jobs),
+        "files_per_s": round(values["files"] / elapsed, 1),
+        "pages_per_s": round(values["pages"] / elapsed, 2),
+        "mb_per_s": round(values["bytes"] / elapsed / 1024 / 1024, 2),
+        "mean_page_ms": round(values["page_seconds"] / values["pages"] * 1000, 2) if values["pages"] else None,
+        "mean_file_ms": round(values["file_seconds"] / values["files"] * 1000, 2) if values["files"] else None,
+        "retries": values["retries"],
+        "throttled": throttled,
+        "errors": values["errors"]
+    }
+
+def int_list(text):
+    return tuple(int(x) for x in text.split(',') if x.strip())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк сервера галереи и краулера")
+    parser.add_argument("--sizes", type=int_list, default=SIZES, help="размеры библиотек через запятую")
+    parser.add_argument("--thumb-sizes", type=int_list, default=THUMB_SIZES,
+                        help="для каких размеров замерять generate_thumbs()")
+    parser.add_argument("--engines", type=lambda s: tuple(s.split(',')), default=ENGINES)
+    parser.add_argument("--concurrency", type=int_list, default=CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DURATION, help="секунд на каждый уровень параллелизма")
+    parser.add_argument("--work-dir", default=None, help="папка для синтетических библиотек (по умолчанию временная)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    parser.add_argument("--skip-server", action="store_true")
+    parser.add_argument("--skip-crawler", action="store_true")
+    parser.add_argument("--crawler-posts", type=int, default=CRAWLER_POSTS)
+    parser.add_argument("--crawler-jobs", type=int, default=CRAWLER_JOBS)
+    parser.add_argument("--crawler-latency", type=float, default=CRAWLER_LATENCY)
+    parser.add_argument("--crawler-file-kb", type=int, default=CRAWLER_FILE_KB)
+    parser.add_argument("--throttle-every", type=int, default=CRAWLER_THROTTLE_EVERY)
+    parser.add_argument("--throttle-for", type=int, default=CRAWLER_THROTTLE_FOR)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--engine", default="threaded", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    if args.serve:
+        serve(args.serve, args.port, args.engine)
+        sys.exit(0)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="gallery-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("serve", "port", "engine")}
+        },
+        "libraries": {},
+        "crawler": None
+    }
+
+    try:
+        if not args.skip_server:
+            templates = make_templates()
+            for size in args.sizes:
+                results["libraries"][str(size)] = bench_library(work_dir, size, templates, args)
+        if not args.skip_crawler:
+            results["crawler"] = bench_crawler(work_dir, args)
+    finally:
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"✅ Результаты: {args.output}")
@@ -0,0 +1,166 @@
+import http.server
+import socketserver
+import threading
+import hashlib
+import argparse
+import json
+import time
+import io
+from urllib.parse import urlsplit, parse_qs
+from PIL import Image
+
+PORT = 8100
+POSTS = 1000
+LATENCY = 0.0
+FILE_KB = 0
+THROTTLE_EVERY = 0
+THROTTLE_FOR = 0
+RETRY_AFTER = 1
+ERROR_FROM_PID = None
+
+class StubState:
+    def __init__(self, posts=POSTS, latency=LATENCY, file_kb=FILE_KB,
+                 throttle_every=THROTTLE_EVERY, throttle_for=THROTTLE_FOR, retry_after=RETRY_AFTER,
+                 error_from_pid=ERROR_FROM_PID):
+        self.posts = posts
+        self.latency = latency
+        self.file_kb = file_kb
+        self.throttle_every = throttle_every
+        self.throttle_for = throttle_for
+        self.retry_after = retry_after
+        self.error_from_pid = error_from_pid
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.bodies = {}
+
+    def should_throttle(self):
+        with self.lock:
+            self.requests += 1
+            if not self.throttle_every:
+                return False
+            if self.requests % (self.throttle_every + self.throttle_for) >= self.throttle_every:
+                self.throttled += 1
+                return True
+            return False
+
+    def body(self, post_id):
+        body = self.bodies.get(post_id)
+        if body is None:
+            color = ((post_id * 37) % 256, (post_id * 91) % 256, (post_id * 173) % 256)
+            buf = io.BytesIO()
+            Image.new('RGB', (64 + post_id % 64, 96), color).save(buf, "JPEG", quality=90)
+            body = buf.getvalue()
+            if self.file_kb:
+                body += bytes(max(0, self.file_kb * 1024 - len(body)))
+            with self.lock:
+                self.bodies[post_id] = body
+        return body
+
+    def post(self, post_id, base_url):
+        body = self.body(post_id)
+        return {
+            "id": post_id,
+            "file_url": f"{base_url}/images/{post_id}.jpg",
+            "hash": hashlib.md5(body).hexdigest(),
+            "tags": f"stub tag_{post_id % 7} tag_{post_id % 13}",
+            "width": 64 + post_id % 64,
+            "height": 96,
+            "score": post_id % 100,
+            "rating": "general"
+        }
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_bytes(self, code, body, content_type, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        if state.latency:
+            time.sleep(state.latency)
+        if state.should_throttle():
+            self.send_bytes(429, b'', 'text/plain', [('Retry-After', str(state.retry_after))])
+            return
+
+        url = urlsplit(self.path)
+        if url.path == '/index.php':
+            self.handle_dapi(parse_qs(url.query))
+        elif url.path.startswith('/images/'):
+            self.handle_file(url.path.rsplit('/', 1)[-1])
+        else:
+            self.send_bytes(404, b'', 'text/plain')
+
+    def handle_dapi(self, params):
+        state = self.server.state
+        limit = int(params.get('limit', ['100'])[0])
+        pid = max(int(params.get('pid', ['0'])[0]), 0)
+        if state.error_from_pid is not None and pid >= state.error_from_pid:
+            self.send_bytes(500, b'', 'text/plain')
+            return
+        newest = state.posts - pid * limit
+        ids = range(newest, max(newest - limit, 0), -1)
+        base_url = f"http://{self.headers.get('Host', f'127.0.0.1:{self.server.server_address[1]}')}"
+        posts = [state.post(post_id, base_url) for post_id in ids]
+        self.send_bytes(200, json.dumps(posts).encode('utf-8'), 'application/json')
+
+    def handle_file(self, name):
+        state = self.server.state
+        try:
+            post_id = int(name.split('.')[0])
+        except ValueError:
+            post_id = 0
+        if not 1 <= post_id <= state.posts:
+            self.send_bytes(404, b'', 'text/plain')
+            return
+        body = state.body(post_id)
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes=') and range_header.endswith('-'):
+            start = int(range_header[6:-1])
+            if start >= len(body):
+                self.send_bytes(416, b'', 'text/plain', [('Content-Range', f'bytes */{len(body)}')])
+                return
+            self.send_bytes(206, body[start:], 'image/jpeg',
+                            [('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')])
+            return
+        self.send_bytes(200, body, 'image/jpeg')
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def make_stub_server(port=PORT, host="127.0.0.1", **options):
+    server = StubServer((host, port), StubHandler)
+    server.state = StubState(**options)
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--posts', type=int, default=POSTS)
+    parser.add_argument('--latency', type=float, default=LATENCY)
+    parser.add_argument('--file-kb', type=int, default=FILE_KB)
+    parser.add_argument('--throttle-every', type=int, default=THROTTLE_EVERY)
+    parser.add_argument('--throttle-for', type=int, default=THROTTLE_FOR)
+    parser.add_argument('--retry-after', type=int, default=RETRY_AFTER)
+    parser.add_argument('--error-from-pid', type=int, default=ERROR_FROM_PID)
+    args = parser.parse_args()
+
+    with make_stub_server(args.port, posts=args.posts, latency=args.latency, file_kb=args.file_kb,
+                          throttle_every=args.throttle_every, throttle_for=args.throttle_for,
+                          retry_after=args.retry_after, error_from_pid=args.error_from_pid) as httpd:
+        print(f"🧪 dapi-заглушка: http://127.0.0.1:{args.port}/index.php")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -3,12 +3,23 @@ import os
 import time
 import json
 import random
+import hashlib
 from tqdm import tqdm
 from pathlib import Path
 from PIL import Image, ImageOps
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 import threading
+import queue
+import sqlite3
+import shutil
+import sys
+import argparse
+import io
+from collections import deque
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # TAG = "umamusume -1futa -futa_with_futa -futanari -huge_breasts"
 TAG = "kitasan_black_(umamusume) -1futa -futa_with_futa -futanari -huge_breasts -armpit_hair -big_ass"
@@ -25,19 +36,437 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
 }
 
-DELAY_PAGE_BASE = 1.0
-DELAY_FILE_BASE = 0.1
+API_URL = "https://api.rule34.xxx/index.php"
+RATE_LIMIT_RPS = 20.0
+RATE_LIMIT_BURST = 40
+DEFAULT_RETRY_AFTER = 15.0
 MAX_RETRIES = 3
 EMPTY_PAGES_LIMIT = 10
+MIN_WORKERS = 1
+INITIAL_WORKERS = 4
 MAX_WORKERS = 8
+THUMB_WORKERS = os.cpu_count() or 1
+THUMB_QUEUE_SIZE = 32
+THUMB_INLINE_BYTES = 8 * 1024 * 1024
+THUMB_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+AIMD_DECREASE = 0.5
+PREFETCH_PAGES = 2
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+PAGE_FETCHERS = 4
+BANDWIDTH_LIMIT = 0
+DB_PATH = "crawler.db"
+BLOB_FOLDER = "blobs"
+CATALOG_DIR = f"{FOLDER}_catalog"
+CATALOG_SHARD_SIZE = 5000
+CATALOG_MANIFEST_INTERVAL = 5.0
+DB_BATCH_SIZE = 200
+STATS_FILE = "crawler_stats.prom"
+STATS_INTERVAL = 5.0
 LOCK = threading.Lock()
 
-os.makedirs(FOLDER, exist_ok=True)
-if GENERATE_THUMBS:
-    os.makedirs(THUMB_FOLDER, exist_ok=True)
+class CrawlStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY,
+                md5 TEXT,
+                file_url TEXT,
+                tags TEXT,
+                width INTEGER,
+                height INTEGER,
+                score INTEGER,
+                rating TEXT,
+                file_size INTEGER,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                folder TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER,
+                downloaded INTEGER NOT NULL DEFAULT 0,
+                thumbnailed INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL,
+                PRIMARY KEY (folder, post_id)
+            );
+            CREATE TABLE IF NOT EXISTS query_posts (
+                query TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                PRIMARY KEY (query, post_id)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                query TEXT PRIMARY KEY,
+                head_id INTEGER,
+                crawl_head_id INTEGER,
+                last_pid INTEGER,
+                completed INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL
+            );
+        """)
+        self.conn.commit()
+        self.pending_files = []
+        self.pending_thumbs = []
 
-session = requests.Session()
-session.headers.update(HEADERS)
+    def save_posts(self, query: str, posts):
+        now = time.time()
+        rows = [(int(p['id']), post_md5(p) or None, p.get('file_url'), p.get('tags'),
+                 p.get('width'), p.get('height'), p.get('score'), p.get('rating'), p.get('file_size'), now)
+                for p in posts if str(p.get('id', '')).isdigit()]
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO posts (id, md5, file_url, tags, width, height, score, rating, file_size, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    md5=excluded.md5, file_url=excluded.file_url, tags=excluded.tags,
+                    width=excluded.width, height=excluded.height, score=excluded.score,
+                    rating=excluded.rating, file_size=COALESCE(excluded.file_size, posts.file_size),
+                    updated_at=excluded.updated_at
+            """, rows)
+            self.conn.executemany("INSERT OR IGNORE INTO query_posts (query, post_id) VALUES (?, ?)",
+                                  [(query, row[0]) for row in rows])
+            self.conn.commit()
+
+    def mark_file(self, folder: str, post_id, filename: str, size, thumbnailed: bool):
+        with self.lock:
+            self.pending_files.append((folder, int(post_id), filename, size, int(thumbnailed), time.time()))
+            if len(self.pending_files) >= DB_BATCH_SIZE:
+                self._flush()
+
+    def mark_thumbnail(self, folder: str, post_id):
+        with self.lock:
+            self.pending_thumbs.append((time.time(), folder, int(post_id)))
+            if len(self.pending_thumbs) >= DB_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self.pending_files and not self.pending_thumbs:
+            return
+        self.conn.executemany("""
+            INSERT INTO files (folder, post_id, filename, size, downloaded, thumbnailed, updated_at)
+            VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT(folder, post_id) DO UPDATE SET
+                filename=excluded.filename, size=excluded.size, downloaded=1,
+                thumbnailed=excluded.thumbnailed, updated_at=excluded.updated_at
+        """, self.pending_files)
+        self.conn.executemany("UPDATE files SET thumbnailed=1, updated_at=? WHERE folder=? AND post_id=?",
+                              self.pending_thumbs)
+        self.conn.commit()
+        self.pending_files = []
+        self.pending_thumbs = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def downloaded_ids(self, folder: str):
+        with self.lock:
+            rows = self.conn.execute("SELECT post_id FROM files WHERE folder=? AND downloaded=1", (folder,))
+            return {row[0] for row in rows}
+
+    def pending_posts(self, query: str, folder: str):
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT p.id, p.file_url, p.md5 FROM query_posts q
+                JOIN posts p ON p.id = q.post_id
+                LEFT JOIN files f ON f.folder = ? AND f.post_id = p.id
+                WHERE q.query = ? AND p.file_url IS NOT NULL AND COALESCE(f.downloaded, 0) = 0
+                ORDER BY p.id DESC
+            """, (folder, query)).fetchall()
+        return [{"id": row[0], "file_url": row[1], "md5": row[2]} for row in rows]
+
+    def unthumbnailed_files(self, folder: str):
+        self.flush()
+        with self.lock:
+            return self.conn.execute("""
+                SELECT f.post_id, f.filename, p.md5 FROM files f
+                LEFT JOIN posts p ON p.id = f.post_id
+                WHERE f.folder = ? AND f.downloaded = 1 AND f.thumbnailed = 0
+                ORDER BY f.post_id
+            """, (folder,)).fetchall()
+
+    def checkpoint(self, query: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT head_id, crawl_head_id, last_pid, completed FROM checkpoints WHERE query=?", (query,)
+            ).fetchone()
+        return row or (None, None, None, 0)
+
+    def save_checkpoint(self, query: str, head_id, crawl_head_id, last_pid, completed: bool):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO checkpoints (query, head_id, crawl_head_id, last_pid, completed, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(query) DO UPDATE SET
+                    head_id=excluded.head_id, crawl_head_id=excluded.crawl_head_id,
+                    last_pid=excluded.last_pid, completed=excluded.completed, updated_at=excluded.updated_at
+            """, (query, head_id, crawl_head_id, last_pid, int(completed), time.time()))
+            self.conn.commit()
+
+    def catalog_files(self, folder: str):
+        self.flush()
+        with self.lock:
+            return self.conn.execute(
+                "SELECT filename, thumbnailed FROM files WHERE folder=? AND downloaded=1 ORDER BY post_id",
+                (folder,)
+            ).fetchall()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RequestPermit:
+    def __init__(self, limiter, slot: bool):
+        self.limiter = limiter
+        self.slot = slot
+        self.outcome = 'ok'
+        self.retry_after = None
+
+    def observe(self, resp):
+        if resp.status_code in (429, 503):
+            self.outcome = 'throttled'
+            self.retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        elif resp.status_code >= 500:
+            self.outcome = 'error'
+
+    def __enter__(self):
+        self.limiter.acquire(self.slot)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.outcome == 'ok':
+            if issubclass(exc_type, (requests.Timeout, requests.ConnectionError)):
+                self.outcome = 'error'
+            elif not issubclass(exc_type, requests.HTTPError):
+                self.outcome = 'neutral'
+        self.limiter.release(self.slot, self.outcome, self.retry_after)
+        return False
+
+class AdaptiveLimiter:
+    def __init__(self, rate: float, burst: int, min_concurrency: int, initial_concurrency: int,
+                 max_concurrency: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.active = 0
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def request(self, slot: bool = True):
+        return RequestPermit(self, slot)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, slot: bool = True):
+        with self.cond:
+            while True:
+                now = self.clock()
+                self._refill(now)
+                if now < self.blocked_until:
+                    self.cond.wait(self.blocked_until - now)
+                elif slot and self.active >= int(self.limit):
+                    self.cond.wait()
+                elif self.tokens < 1:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    if slot:
+                        self.active += 1
+                    return
+
+    def release(self, slot: bool, outcome: str, retry_after=None):
+        with self.cond:
+            if slot:
+                self.active -= 1
+            if outcome == 'ok':
+                self.successes += 1
+                if self.successes >= int(self.limit):
+                    self.successes = 0
+                    self.limit = min(self.max_concurrency, self.limit + 1)
+            elif outcome in ('throttled', 'error'):
+                self.successes = 0
+                self.limit = max(self.min_concurrency, self.limit * AIMD_DECREASE)
+                if outcome == 'throttled':
+                    self.throttled += 1
+                    delay = DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+                    self.blocked_until = max(self.blocked_until, self.clock() + delay)
+                else:
+                    self.errors += 1
+            self.cond.notify_all()
+
+    def status(self) -> str:
+        with self.cond:
+            paused = max(0.0, self.blocked_until - self.clock())
+            text = f"⚡ {self.active}/{int(self.limit)} потоков | 429: {self.throttled} | ошибок: {self.errors}"
+            return text + (f" | пауза {paused:.0f} с" if paused > 0 else "")
+
+class BandwidthBudget:
+    def __init__(self, rate: float, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.next_free = clock()
+        self.consumed = 0
+
+    def consume(self, nbytes: int):
+        with self.lock:
+            self.consumed += nbytes
+            if not self.rate:
+                return
+            now = self.clock()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+class CrawlStats:
+    COUNTERS = (
+        ("pages", "Dapi pages fetched."),
+        ("page_seconds", "Time spent fetching dapi pages."),
+        ("files", "Files downloaded."),
+        ("file_seconds", "Time spent downloading files."),
+        ("bytes", "Bytes downloaded."),
+        ("retries", "Page and file requests retried."),
+        ("throttled", "Responses with HTTP 429/503."),
+        ("errors", "Requests that failed."),
+    )
+
+    def __init__(self, path: str, interval: float = STATS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.values = {name: 0 for name, _ in self.COUNTERS}
+        self.started = time.time()
+        self.last = (self.started, dict(self.values))
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, name: str, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def render(self) -> str:
+        now = time.time()
+        with self.lock:
+            values = dict(self.values)
+        last_time, last_values = self.last
+        self.last = (now, values)
+        window = max(now - last_time, 1e-6)
+        elapsed = max(now - self.started, 1e-6)
+        
+        lines = []
+        for name, help_text in self.COUNTERS:
+            metric = f"crawler_{name}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter", f"{metric} {values[name]}"]
+        gauges = (
+            ("crawler_pages_per_second", "Pages per second over the last interval.",
+             (values["pages"] - last_values["pages"]) / window),
+            ("crawler_megabytes_per_second", "MB/s over the last interval.",
+             (values["bytes"] - last_values["bytes"]) / window / 1024 / 1024),
+            ("crawler_page_latency_seconds", "Mean page fetch time.",
+             values["page_seconds"] / values["pages"] if values["pages"] else 0),
+            ("crawler_file_latency_seconds", "Mean file download time.",
+             values["file_seconds"] / values["files"] if values["files"] else 0),
+            ("crawler_uptime_seconds", "Seconds since the crawl started.", elapsed),
+        )
+        for metric, help_text, value in gauges:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge", f"{metric} {value:.6f}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def start(self):
+        if self.path and self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+class FairQueue:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.order = deque()
+        self.open = set()
+
+    def register(self, key):
+        with self.cond:
+            self.queues[key] = deque()
+            self.order.append(key)
+            self.open.add(key)
+
+    def put(self, key, item):
+        with self.cond:
+            while len(self.queues[key]) >= self.capacity:
+                self.cond.wait()
+            self.queues[key].append(item)
+            self.cond.notify_all()
+
+    def finish(self, key):
+        with self.cond:
+            self.open.discard(key)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while True:
+                for _ in range(len(self.order)):
+                    key = self.order[0]
+                    self.order.rotate(-1)
+                    if self.queues[key]:
+                        item = self.queues[key].popleft()
+                        self.cond.notify_all()
+                        return key, item
+                if not self.open:
+                    return None
+                self.cond.wait()
 
 def random_delay(base: float):
     delay = base + random.uniform(-0.3, 0.5)
@@ -54,12 +483,9 @@ def safe_json_parse(resp_text: str):
     except json.JSONDecodeError:
         return []
 
-def create_thumbnail(full_path: str, post_id: str):
-    thumb_path = os.path.join(THUMB_FOLDER, f"{post_id}.jpg")
-    if os.path.exists(thumb_path):
-        return
+def render_thumbnail(source, thumb_path: str):
     try:
-        with Image.open(full_path) as img:
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
             if img.mode in ('RGBA', 'LA', 'P'):
                 background = Image.new('RGB', img.size, (30, 30, 30))
                 if img.mode == 'P':
@@ -69,152 +495,676 @@ def create_thumbnail(full_path: str, post_id: str):
             else:
                 img = img.convert('RGB')
             img.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
-            img.save(thumb_path, "JPEG", quality=THUMB_QUALITY, optimize=True, progressive=True)
+            tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, "JPEG", quality=THUMB_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, thumb_path)
+        return True
     except:
-        pass
-
-def download_file_task(post):
-    post_id = str(post.get('id', 'unknown'))
-    file_url = post.get('file_url')
-    
-    if not file_url:
         return False
-    
-    ext = file_url.rsplit('.', 1)[-1].split('?')[0].lower()
-    ext = ext if ext in ('jpg', 'jpeg', 'png', 'gif', 'webp', 'webm', 'mp4', 'swf') else 'jpg'
-    filename = f"{post_id}.{ext}"
-    full_path = os.path.join(FOLDER, filename)
-
-    if os.path.exists(full_path):
-        if GENERATE_THUMBS and ext in ('jpg', 'jpeg', 'png', 'gif', 'webp'):
-            create_thumbnail(full_path, post_id)
-        return True
 
-    for attempt in range(MAX_RETRIES):
-        try:
-            with session.get(file_url, stream=True, timeout=60) as r:
-                r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0))
-                with open(full_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=32768):
-                        if chunk:
-                            f.write(chunk)
-                if GENERATE_THUMBS and ext in ('jpg', 'jpeg', 'png', 'gif', 'webp'):
-                    create_thumbnail(full_path, post_id)
+class ThumbnailStage:
+    def __init__(self, workers: int, queue_size: int, on_done=None):
+        self.workers = workers
+        self.on_done = on_done
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.executor = None
+        self.thread = None
+        self.bar = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.slots = threading.Semaphore(self.workers * 2)
+        self.bar = tqdm(desc="🖼️ Превью", unit="шт")
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, post_id: str, filename: str, source, target: str, thumb_path: str):
+        if self.thread is None:
+            if render_thumbnail(source, target):
+                if target != thumb_path:
+                    link_file(target, thumb_path)
                 return True
-        except:
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(random_delay(1))
-            else:
-                if os.path.exists(full_path):
-                    os.remove(full_path)
-    return False
-
-def download_posts_parallel(posts):
-    downloaded = 0
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(download_file_task, post) for post in posts]
-        for future in tqdm(futures, desc="📥 Файлы", leave=False):
+            return False
+        self.queue.put((job, post_id, filename, source, target, thumb_path))
+        return None
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.slots.acquire()
+            future = self.executor.submit(render_thumbnail, item[3], item[4])
+            future.add_done_callback(lambda f, item=item: self._done(f, item))
+
+    def _done(self, future, item):
+        self.slots.release()
+        job, post_id, filename, _, target, thumb_path = item
+        ok = False
+        try:
             if future.result():
-                with LOCK:
-                    downloaded += 1
-    return downloaded
-
-print("🚀 ТУРБО-ПАРСЕР Rule34.xxx — pid += 1!")
-print(f"🔗 https://rule34.xxx/index.php?page=post&s=list&tags={quote(TAG)}")
-print(f"📁 {FOLDER}")
-print("-" * 70)
-
-pages_bar = tqdm(desc="Страницы", unit="стр")
-consecutive_empty = 0
-total_downloaded = 0
-pid = START_PAGE - 1  
-
-while True:
-    tags_encoded = quote(TAG)
-    
+                if target != thumb_path:
+                    link_file(target, thumb_path)
+                ok = True
+        except Exception:
+            pass
+        if self.on_done is not None:
+            self.on_done(job, post_id, filename, ok)
+        self.bar.update(1)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.bar.close()
+        self.thread = None
+
+def catalog_item(file: str, thumbnailed: bool):
+    post_id = file.split('.')[0]
+    return {
+        "name": file,
+        "url": f"/static/{file}",
+        "thumb": f"/static/thumbs/{post_id}.jpg" if thumbnailed else None,
+        "isVideo": file.lower().endswith(('.mp4', '.webm'))
+    }
+
+class CatalogWriter:
+    def __init__(self, folder: str, shard_size: int = CATALOG_SHARD_SIZE):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.manifest_path = os.path.join(folder, "manifest.json")
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {"shard_size": shard_size, "shards": []}
+        self.shard_size = self.manifest["shard_size"]
+        self.log_path = os.path.join(folder, self.manifest.get("log", {}).get("file", "log.jsonl"))
+        
+        self.names = set()
+        for shard in self.manifest["shards"]:
+            with open(os.path.join(folder, shard["file"]), 'rb') as f:
+                self.names.update(json.loads(line)["name"] for line in f)
+        
+        self.log_count = 0
+        self.log_thumbs = 0
+        valid_bytes = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    valid_bytes += len(line)
+                    self.names.add(item["name"])
+                    self.log_count += 1
+                    self.log_thumbs += bool(item.get("thumb"))
+            os.truncate(self.log_path, valid_bytes)
+        self.log = open(self.log_path, 'ab')
+        self.manifest_written = 0
+        self._write_manifest()
+
+    def append(self, item: dict):
+        with self.lock:
+            if item["name"] in self.names:
+                return
+            self.names.add(item["name"])
+            self.log.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n')
+            self.log.flush()
+            self.log_count += 1
+            self.log_thumbs += bool(item.get("thumb"))
+            if self.log_count >= self.shard_size:
+                self._compact()
+            elif time.time() - self.manifest_written >= CATALOG_MANIFEST_INTERVAL:
+                self._write_manifest()
+
+    def _compact(self):
+        self.log.close()
+        number = len(self.manifest["shards"])
+        shard_file = f"shard-{number:05d}.jsonl"
+        index_file = f"shard-{number:05d}.idx"
+        shard_path = os.path.join(self.folder, shard_file)
+        old_log_path = self.log_path
+        
+        offsets = array('Q', [0])
+        with open(old_log_path, 'rb') as src, open(shard_path, 'wb') as dst:
+            for line in src:
+                dst.write(line)
+                offsets.append(offsets[-1] + len(line))
+        with open(os.path.join(self.folder, index_file), 'wb') as f:
+            offsets.tofile(f)
+        
+        self.manifest["shards"].append({
+            "file": shard_file,
+            "index": index_file,
+            "count": self.log_count,
+            "thumbs": self.log_thumbs,
+            "bytes": offsets[-1]
+        })
+        self.log_count = 0
+        self.log_thumbs = 0
+        self.log_path = os.path.join(self.folder, f"log-{number + 1:05d}.jsonl")
+        self.log = open(self.log_path, 'wb')
+        self._write_manifest()
+        os.remove(old_log_path)
+
+    def _write_manifest(self):
+        self.manifest["log"] = {"file": os.path.basename(self.log_path), "count": self.log_count,
+                                "thumbs": self.log_thumbs}
+        self.manifest["total"] = sum(s["count"] for s in self.manifest["shards"]) + self.log_count
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self.manifest_written = time.time()
+
+    def close(self):
+        with self.lock:
+            self._write_manifest()
+            self.log.close()
+        return self.manifest["total"]
+
+def blob_path(md5: str, ext: str) -> str:
+    return os.path.join(BLOB_FOLDER, md5[:2], f"{md5}.{ext}")
+
+def thumb_blob_path(md5: str) -> str:
+    return os.path.join(BLOB_FOLDER, "thumbs", md5[:2], f"{md5}.jpg")
+
+def link_file(src: str, dst: str):
+    tmp_path = f"{dst}.link"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), tmp_path)
+        except OSError:
+            shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+def store_blob(path: str, md5: str, ext: str) -> str:
+    blob = blob_path(md5, ext)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if os.path.exists(blob):
+        os.remove(path)
+    else:
+        os.replace(path, blob)
+    return blob
+
+def dedupe_folders(folders):
+    linked = 0
+    saved = 0
+    for folder in folders:
+        with os.scandir(folder) as it:
+            entries = [e for e in it if e.is_file(follow_symlinks=False)
+                       and not e.name.endswith(('.part', '.link', '.tmp'))]
+        for entry in tqdm(entries, desc=f"🧬 {folder}", unit="файл"):
+            md5 = file_md5(entry.path)
+            ext = entry.name.rsplit('.', 1)[-1].lower()
+            blob = blob_path(md5, ext)
+            if os.path.exists(blob):
+                if os.path.samefile(blob, entry.path):
+                    continue
+                saved += entry.stat().st_size
+                link_file(blob, entry.path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(entry.path, blob)
+                except OSError:
+                    os.replace(entry.path, blob)
+                    link_file(blob, entry.path)
+            linked += 1
+    print(f"🧬 В хранилище {BLOB_FOLDER}: {linked} файлов, освобождено {saved / 1024 / 1024:.1f} МБ")
+
+def post_md5(post) -> str:
+    return (post.get('md5') or post.get('hash') or '').lower()
+
+def file_md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def expected_total_size(resp, offset: int):
+    content_range = resp.headers.get('content-range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = resp.headers.get('content-length')
+    return offset + int(length) if length else None
+
+
+def build_api_url(api_url: str, tag: str, pid: int):
     api_url = (
-        f"https://api.rule34.xxx/index.php?page=dapi"
+        f"{api_url}?page=dapi"
         f"&s=post&q=index&json=1"
-        f"&tags={tags_encoded}"
+        f"&tags={quote(tag)}"
         f"&limit={LIMIT_PER_PAGE}"
         f"&pid={pid}"
     )
-    
     if YOUR_API_KEY:
         api_url += f"&api_key={YOUR_API_KEY}"
     if YOUR_USER_ID:
         api_url += f"&user_id={YOUR_USER_ID}"
+    return api_url
 
-    posts = []
-    retries = 0
+def job_folder(tag: str) -> str:
+    terms = sorted(set(tag.lower().split()))
+    first = next((t for t in tag.split() if not t.startswith('-')), tag.strip() or "posts")
+    name = first
+    if name.endswith(')') and '_(' in name:
+        name = name[:name.rindex('_(')]
+    name = "".join(c if c.isalnum() or c in '_-' else '_' for c in name)
+    if terms != [first.lower()] and terms:
+        name += "_" + hashlib.sha1(" ".join(terms).encode('utf-8')).hexdigest()[:8]
+    return name
+
+def check_jobs(jobs):
+    seen = {}
+    for job in jobs:
+        for folder in (job.folder, job.thumb_folder, job.catalog_dir):
+            key = os.path.normcase(os.path.abspath(folder))
+            other = seen.setdefault(key, job)
+            if other is not job:
+                raise ValueError(f"jobs {other.tag!r} and {job.tag!r} share the folder {folder}")
+    return jobs
+
+class CrawlJob:
+    def __init__(self, tag: str, folder: str = None, thumb_folder: str = None, catalog_dir: str = None):
+        self.tag = tag
+        self.folder = folder or job_folder(tag)
+        self.thumb_folder = thumb_folder or f"{self.folder}_thumbs"
+        self.catalog_dir = catalog_dir or f"{self.folder}_catalog"
+        self.page_stats = {}
+        self.known_ids = set()
+        self.catalog = None
+        self.downloaded = 0
+        self.failed = 0
+
+def load_jobs(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        spec = spec.get('jobs', [])
+    jobs = []
+    for entry in spec:
+        if isinstance(entry, str):
+            jobs.append(CrawlJob(entry))
+        else:
+            jobs.append(CrawlJob(entry['tag'], entry.get('folder'), entry.get('thumb_folder'),
+                                 entry.get('catalog_dir')))
+    return check_jobs(jobs)
+
+class Crawler:
+    def __init__(self, api_url: str = API_URL, db_path: str = DB_PATH, workers: int = MAX_WORKERS,
+                 rate: float = RATE_LIMIT_RPS, burst: int = RATE_LIMIT_BURST, bandwidth: float = BANDWIDTH_LIMIT,
+                 generate_thumbs: bool = GENERATE_THUMBS, thumb_workers: int = THUMB_WORKERS,
+                 stats_path: str = STATS_FILE):
+        self.api_url = api_url
+        self.workers = workers
+        self.generate_thumbs = generate_thumbs
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                              pool_maxsize=max(POOL_MAXSIZE, workers + PAGE_FETCHERS))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.store = CrawlStore(db_path)
+        self.limiter = AdaptiveLimiter(rate, burst, MIN_WORKERS, min(INITIAL_WORKERS, workers), workers)
+        self.bandwidth = BandwidthBudget(bandwidth)
+        self.page_slots = threading.BoundedSemaphore(PAGE_FETCHERS)
+        self.thumb_stage = ThumbnailStage(thumb_workers, THUMB_QUEUE_SIZE, self.thumb_done)
+        self.stats = CrawlStats(stats_path)
+        self.queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.session.close()
+        self.store.close()
+
+    def finish_file(self, job: CrawlJob, post_id: str, filename: str, size: int, thumbnailed):
+        self.store.mark_file(job.folder, post_id, filename, size, bool(thumbnailed))
+        if thumbnailed is not None and job.catalog is not None:
+            job.catalog.append(catalog_item(filename, thumbnailed))
+
+    def thumb_done(self, job: CrawlJob, post_id: str, filename: str, ok: bool):
+        if ok:
+            self.store.mark_thumbnail(job.folder, post_id)
+        if job.catalog is not None:
+            job.catalog.append(catalog_item(filename, ok))
+
+    def create_thumbnail(self, job: CrawlJob, full_path: str, post_id: str, md5: str = '', data: bytes = None):
+        thumb_path = os.path.join(job.thumb_folder, f"{post_id}.jpg")
+        if os.path.exists(thumb_path):
+            return True
+        filename = os.path.basename(full_path)
+        source = data if data is not None else full_path
+        if not md5:
+            return self.thumb_stage.submit(job, post_id, filename, source, thumb_path, thumb_path)
+        blob = thumb_blob_path(md5)
+        if os.path.exists(blob):
+            link_file(blob, thumb_path)
+            return True
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        return self.thumb_stage.submit(job, post_id, filename, source, blob, thumb_path)
+
+    def pending_thumbnails(self, job: CrawlJob):
+        rows = self.store.unthumbnailed_files(job.folder)
+        return [(str(post_id), filename, md5 or '') for post_id, filename, md5 in rows
+                if filename.rsplit('.', 1)[-1].lower() in THUMB_EXTENSIONS
+                and os.path.exists(os.path.join(job.folder, filename))]
+
+    def requeue_thumbnails(self, job: CrawlJob, pending):
+        if pending:
+            print(f"🔁 {job.folder}: доделываем превью для {len(pending)} файлов")
+        for post_id, filename, md5 in pending:
+            ok = self.create_thumbnail(job, os.path.join(job.folder, filename), post_id, md5)
+            if ok is not None:
+                self.thumb_done(job, post_id, filename, ok)
+
+    def download(self, job: CrawlJob, post):
+        post_id = str(post.get('id', 'unknown'))
+        file_url = post.get('file_url')
+        
+        if not file_url:
+            return False
+        
+        ext = file_url.rsplit('.', 1)[-1].split('?')[0].lower()
+        ext = ext if ext in ('jpg', 'jpeg', 'png', 'gif', 'webp', 'webm', 'mp4', 'swf') else 'jpg'
+        filename = f"{post_id}.{ext}"
+        full_path = os.path.join(job.folder, filename)
+        part_path = f"{full_path}.part"
+        md5 = post_md5(post)
+        thumbable = self.generate_thumbs and ext in THUMB_EXTENSIONS
 
-    while retries < MAX_RETRIES:
+        if not os.path.exists(full_path) and md5 and os.path.exists(blob_path(md5, ext)):
+            link_file(blob_path(md5, ext), full_path)
+
+        if os.path.exists(full_path):
+            thumbnailed = self.create_thumbnail(job, full_path, post_id, md5) if thumbable else False
+            self.finish_file(job, post_id, filename, os.path.getsize(full_path), thumbnailed)
+            return True
+
+        for attempt in range(MAX_RETRIES):
+            started = time.perf_counter()
+            permit = None
+            try:
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                headers = {'Range': f'bytes={offset}-'} if offset else None
+                with self.limiter.request() as permit, \
+                        self.session.get(file_url, stream=True, timeout=60, headers=headers) as r:
+                    permit.observe(r)
+                    hasher, keep, chunks = None, False, []
+                    if r.status_code == 416 and offset:
+                        total_size = offset
+                    else:
+                        r.raise_for_status()
+                        if offset and r.status_code != 206:
+                            offset = 0
+                        total_size = expected_total_size(r, offset)
+                        hasher = hashlib.md5() if not offset else None
+                        keep = (thumbable and not offset
+                                and total_size is not None and total_size <= THUMB_INLINE_BYTES)
+                        with open(part_path, 'ab' if offset else 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=32768):
+                                if chunk:
+                                    self.bandwidth.consume(len(chunk))
+                                    self.stats.add("bytes", len(chunk))
+                                    f.write(chunk)
+                                    if hasher is not None:
+                                        hasher.update(chunk)
+                                    if keep:
+                                        chunks.append(chunk)
+                
+                size = os.path.getsize(part_path)
+                if total_size is not None and size < total_size:
+                    raise IOError(f"incomplete: {size}/{total_size}")
+                digest = hasher.hexdigest() if hasher is not None else (file_md5(part_path) if md5 else '')
+                if (total_size is not None and size != total_size) or (md5 and digest != md5):
+                    os.remove(part_path)
+                    raise IOError("checksum mismatch")
+                data = b''.join(chunks) if keep else None
+                
+                if md5:
+                    link_file(store_blob(part_path, md5, ext), full_path)
+                else:
+                    os.replace(part_path, full_path)
+                thumbnailed = self.create_thumbnail(job, full_path, post_id, md5, data) if thumbable else False
+                self.finish_file(job, post_id, filename, size, thumbnailed)
+                self.stats.add("files")
+                self.stats.add("file_seconds", time.perf_counter() - started)
+                return True
+            except:
+                self.stats.add("throttled" if permit is not None and permit.outcome == 'throttled' else "errors")
+                if attempt < MAX_RETRIES - 1:
+                    self.stats.add("retries")
+                    time.sleep(random_delay(1))
+        return False
+
+    def fetch_page(self, job: CrawlJob, pid: int):
+        retries = 0
+        while retries < MAX_RETRIES:
+            if retries:
+                self.stats.add("retries")
+            try:
+                with self.page_slots, self.limiter.request(slot=False) as permit:
+                    started = time.perf_counter()
+                    resp = self.session.get(build_api_url(self.api_url, job.tag, pid), timeout=30)
+                    permit.observe(resp)
+                print(f"\n📡 {job.folder} pid={pid} (стр={(pid//42)+1}): статус={resp.status_code}")
+                
+                if permit.outcome == 'throttled':
+                    self.stats.add("throttled")
+                    print(f"⏳ Rate limit — ждём {permit.retry_after or DEFAULT_RETRY_AFTER:.0f} сек")
+                    retries += 1
+                    continue
+                    
+                resp.raise_for_status()
+                self.stats.add("pages")
+                self.stats.add("page_seconds", time.perf_counter() - started)
+                return safe_json_parse(resp.text)
+                
+            except:
+                self.stats.add("errors")
+                retries += 1
+                if retries < MAX_RETRIES:
+                    time.sleep(random_delay(2))
+        return None
+
+    def produce(self, job: CrawlJob, pages_bar):
         try:
-            resp = session.get(api_url, timeout=30)
-            print(f"\n📡 pid={pid} (стр={(pid//42)+1}): статус={resp.status_code}")
+            self.page_producer(job, pages_bar)
+        finally:
+            self.queue.finish(job)
+
+    def page_producer(self, job: CrawlJob, pages_bar):
+        store = self.store
+        head_id, crawl_head_id, last_pid, completed = store.checkpoint(job.tag)
+        stop_at = head_id if completed else None
+        if completed:
+            crawl_head_id = None
+        
+        pending = [p for p in store.pending_posts(job.tag, job.folder) if p['id'] not in job.known_ids]
+        if pending:
+            print(f"🔁 {job.folder}: повторяем {len(pending)} недокачанных постов")
+            with LOCK:
+                job.page_stats['retry'] = [0, 0, len(pending)]
+            for post in pending:
+                self.queue.put(job, ('retry', post))
+        
+        pending_ids = {p['id'] for p in pending}
+        consecutive_empty = 0
+        pid = START_PAGE - 1
+        if not completed and last_pid is not None and last_pid > pid:
+            pid = last_pid
+            print(f"⏩ {job.folder}: продолжаем с pid={pid}")
+        
+        while True:
+            posts = self.fetch_page(job, pid)
             
-            if resp.status_code == 429:
-                print("⏳ Rate limit — ждём 15 сек")
-                time.sleep(15)
-                retries += 1
-                continue
+            if posts is None:
+                print(f"\n❌ {job.folder} pid={pid}: API не отвечает — продолжим с этой страницы при следующем запуске")
+                store.save_checkpoint(job.tag, head_id, crawl_head_id, pid, completed)
+                return
+            
+            if not posts:
+                consecutive_empty += 1
+                pages_bar.set_postfix_str(f"❌ 0 | Пустых: {consecutive_empty}/{EMPTY_PAGES_LIMIT}")
+                
+                if consecutive_empty >= EMPTY_PAGES_LIMIT:
+                    print(f"\n✅ ✅ ✅ {job.folder}: {EMPTY_PAGES_LIMIT} пустых подряд — ВСЕ СПАРСЕНЫ!")
+                    break
+            else:
+                consecutive_empty = 0
+                store.save_posts(job.tag, posts)
+                ids = [int(p['id']) for p in posts if str(p.get('id', '')).isdigit()]
+                if ids:
+                    crawl_head_id = max(crawl_head_id or 0, max(ids))
+                reached_known = stop_at is not None and any(i <= stop_at for i in ids)
+                
+                fresh = [p for p in posts if not str(p.get('id', '')).isdigit()
+                         or (int(p['id']) not in job.known_ids and int(p['id']) not in pending_ids)]
+                job.known_ids.update(int(p['id']) for p in fresh if str(p.get('id', '')).isdigit())
+                pages_bar.set_postfix_str(f"{len(posts)} постов, новых {len(fresh)}")
+                if fresh:
+                    with LOCK:
+                        job.page_stats[pid] = [0, 0, len(fresh)]
+                    for post in fresh:
+                        self.queue.put(job, (pid, post))
                 
-            resp.raise_for_status()
-            posts = safe_json_parse(resp.text)
-            break
+                store.save_checkpoint(job.tag, head_id, crawl_head_id, pid, completed)
+                if reached_known:
+                    print(f"\n✅ {job.folder} pid={pid}: дошли до уже известных постов (id ≤ {stop_at})")
+                    break
             
-        except:
-            retries += 1
-            if retries < MAX_RETRIES:
-                time.sleep(random_delay(2))
-
-    if retries >= MAX_RETRIES or not posts:
-        consecutive_empty += 1
-        pages_bar.set_postfix_str(f"❌ 0 | Пустых: {consecutive_empty}/{EMPTY_PAGES_LIMIT}")
+            pid += 1
+            pages_bar.update(1)
         
-        if consecutive_empty >= EMPTY_PAGES_LIMIT:
-            print(f"\n✅ ✅ ✅ {EMPTY_PAGES_LIMIT} пустых подряд — ВСЕ СПАРСЕНЫ!")
-            break
-            
-        pid += 1  
-        time.sleep(random_delay(DELAY_PAGE_BASE))
-        pages_bar.update(1)
-        continue
-
-    consecutive_empty = 0
-    pages_bar.set_postfix_str(f"{len(posts)} постов")
-
-    page_downloaded = download_posts_parallel(posts)
-    with LOCK:
-        total_downloaded += page_downloaded
-        print(f"📊 pid={pid}: скачано {page_downloaded}/{len(posts)}")
-    
-    pid += 1  
-    time.sleep(random_delay(DELAY_PAGE_BASE))
-    pages_bar.update(1)
-
-print("\n" + "═" * 80)
-print("✅ ✅ ✅ ПАРСЕР ЗАВЕРШЁН!")
-print(f"📥 Новых файлов: {total_downloaded}")
-print(f"📁 Всего в {FOLDER}: {len(os.listdir(FOLDER))}")
-
-catalog = []
-for file in os.listdir(FOLDER):
-    if file.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.webm')):
-        post_id = file.split('.')[0]
-        thumb_path = f"{post_id}.jpg"
-        is_video = file.lower().endswith(('.mp4', '.webm'))
-        catalog.append({
-            "name": file,
-            "url": f"/static/{file}",
-            "thumb": f"/static/thumbs/{thumb_path}" if os.path.exists(os.path.join(THUMB_FOLDER, thumb_path)) else None,
-            "isVideo": is_video
-        })
+        new_head = max(i for i in (head_id, crawl_head_id) if i is not None) if (head_id or crawl_head_id) else None
+        store.save_checkpoint(job.tag, new_head, None, pid, True)
+
+    def download_worker(self, files_bar):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            job, (pid, post) = item
+            ok = self.download(job, post)
+            files_bar.update(1)
+            files_bar.set_postfix_str(self.limiter.status(), refresh=False)
+            with LOCK:
+                stats = job.page_stats[pid]
+                stats[0] += 1
+                if ok:
+                    stats[1] += 1
+                    job.downloaded += 1
+                else:
+                    job.failed += 1
+                if stats[0] == stats[2]:
+                    print(f"📊 {job.folder} pid={pid}: скачано {stats[1]}/{stats[2]}")
+                    del job.page_stats[pid]
+
+    def run(self, jobs):
+        check_jobs(jobs)
+        self.queue = FairQueue(LIMIT_PER_PAGE * PREFETCH_PAGES)
+        pending_thumbs = {}
+        for job in jobs:
+            os.makedirs(job.folder, exist_ok=True)
+            if self.generate_thumbs:
+                os.makedirs(job.thumb_folder, exist_ok=True)
+                pending_thumbs[job] = self.pending_thumbnails(job)
+            job.known_ids = self.store.downloaded_ids(job.folder)
+            job.catalog = CatalogWriter(job.catalog_dir)
+            retrying = {filename for _, filename, _ in pending_thumbs.get(job, ())}
+            for file, thumbnailed in self.store.catalog_files(job.folder):
+                if file not in retrying:
+                    job.catalog.append(catalog_item(file, thumbnailed))
+            self.queue.register(job)
+        
+        pages_bar = tqdm(desc="Страницы", unit="стр")
+        files_bar = tqdm(desc="📥 Файлы", unit="файл")
+        self.stats.start()
+        if self.generate_thumbs:
+            self.thumb_stage.start()
+            for job, pending in pending_thumbs.items():
+                self.requeue_thumbnails(job, pending)
+        workers = [threading.Thread(target=self.download_worker, args=(files_bar,), daemon=True)
+                   for _ in range(self.workers)]
+        producers = [threading.Thread(target=self.produce, args=(job, pages_bar), daemon=True) for job in jobs]
+        for thread in workers + producers:
+            thread.start()
+        
+        for thread in producers + workers:
+            thread.join()
+        self.thumb_stage.close()
+        files_bar.close()
+        pages_bar.close()
+        self.store.flush()
+        self.stats.close()
+        for job in jobs:
+            job.catalog.close()
+        return jobs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api-url", default=API_URL, help="адрес dapi (например, локальная заглушка)")
+    parser.add_argument("--tag", action="append", metavar="QUERY", help="тег-запрос; можно указать несколько раз")
+    parser.add_argument("--jobs", metavar="FILE", help="JSON со списком заданий: [{\"tag\": ..., \"folder\": ...}]")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="общий пул загрузчиков")
+    parser.add_argument("--rps", type=float, default=RATE_LIMIT_RPS, help="общий лимит запросов в секунду")
+    parser.add_argument("--bandwidth", type=float, default=BANDWIDTH_LIMIT / 1024 / 1024,
+                        help="общий лимит скорости, МБ/с (0 — без ограничения)")
+    parser.add_argument("--stats", default=STATS_FILE, help="файл со счётчиками в формате Prometheus")
+    parser.add_argument("--dedupe", nargs="*", metavar="FOLDER",
+                        help="перенести файлы папок в хранилище по md5 и заменить их ссылками")
+    args = parser.parse_args()
+
+    if args.dedupe is not None:
+        dedupe_folders(args.dedupe or [FOLDER])
+        sys.exit(0)
+
+    jobs = load_jobs(args.jobs) if args.jobs else []
+    jobs += [CrawlJob(tag) for tag in args.tag or []]
+    if not jobs:
+        jobs = [CrawlJob(TAG, FOLDER, THUMB_FOLDER, CATALOG_DIR)]
+    try:
+        check_jobs(jobs)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    print("🚀 ТУРБО-ПАРСЕР Rule34.xxx — pid += 1!")
+    for job in jobs:
+        print(f"🔗 https://rule34.xxx/index.php?page=post&s=list&tags={quote(job.tag)}")
+        print(f"📁 {job.folder}")
+    print("-" * 70)
 
-with open("catalog.json", "w", encoding="utf-8") as f:
-    json.dump(catalog, f, ensure_ascii=False, indent=2)
+    with Crawler(args.api_url, workers=args.workers, rate=args.rps, burst=max(1, int(args.rps * 2)),
+                 bandwidth=args.bandwidth * 1024 * 1024, stats_path=args.stats) as crawler:
+        started = time.time()
+        crawler.run(jobs)
+        elapsed = max(time.time() - started, 1e-6)
 
-print(f"📄 catalog.json готов!")
-print(f"🔗 http://localhost:3000/?tag={quote(TAG)}")
-print("═" * 80)
+        print("\n" + "═" * 80)
+        print("✅ ✅ ✅ ПАРСЕР ЗАВЕРШЁН!")
+        for job in jobs:
+            print(f"📁 {job.folder}: новых {job.downloaded}, ошибок {job.failed}, "
+                  f"всего {len(crawler.store.catalog_files(job.folder))}, каталог {job.catalog_dir}")
+            print(f"🔗 http://localhost:3000/?tag={quote(job.tag)}")
+        print(f"📶 {crawler.bandwidth.consumed / 1024 / 1024:.1f} МБ за {elapsed:.0f} с "
+              f"({crawler.bandwidth.consumed / 1024 / 1024 / elapsed:.2f} МБ/с)")
+        print("═" * 80)
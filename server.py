@@ -2,10 +2,40 @@ import http.server
 import socketserver
 import os
 import json
-from PIL import Image
+from PIL import Image, ImageSequence
 import socket
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import hashlib
+import shutil
+import subprocess
+import threading
+import time
+import bisect
+import math
+import gzip
+import io
+import asyncio
+import argparse
+import mmap
+import struct
+import sqlite3
+import heapq
+import sys
+from array import array
+from collections import OrderedDict, deque
+from itertools import chain, combinations
+from urllib.parse import urlsplit, unquote, parse_qs
+from email.utils import parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 PORT = 8000
 IMAGE_FOLDER = "umamusume_downloads"
@@ -13,70 +43,2211 @@ THUMB_FOLDER = "umamusume_thumbs"
 THUMB_SIZE = (320, 426)
 THUMB_QUALITY = 88
 PAGE_SIZE = 50
+THUMB_WORKERS = os.cpu_count() or 1
+THUMB_REPORT_INTERVAL = 2.0
+THUMB_MANIFEST = "umamusume_thumbs.manifest.json"
+THUMB_META = "umamusume_thumbs.meta.json"
+THUMB_SYNC_STATE = "umamusume_thumbs.sync.json"
+THUMB_PIPELINE_VERSION = 1
+MANIFEST_SAVE_INTERVAL = 30.0
+DESCRIBE_BATCH = 256
+THUMB_CACHE_FOLDER = "umamusume_thumb_cache"
+THUMB_CACHE_BYTES = 512 * 1024 * 1024
+THUMB_PACK_FOLDER = "umamusume_thumb_packs"
+THUMB_PACK_BYTES = 256 * 1024 * 1024
+THUMB_PACK_MAGIC = b'TPK1'
+THUMB_PACK_PREBUILD = 8
+THUMB_PACK_POLL_INTERVAL = 5.0
+THUMB_PACK_PREFETCH_WORKERS = 2
+THUMB_STORE_FOLDER = "umamusume_thumbs.store"
+THUMB_SEGMENT_BYTES = 256 * 1024 * 1024
+THUMB_STORE_COMPACT_RATIO = 0.5
+THUMB_STORE_COMPACT_MIN = 16 * 1024 * 1024
+THUMB_STORE_RECORD = struct.Struct('<HHQIQ')
+THUMB_STORE_TOMBSTONE = 0xFFFF
+THUMB_MIN_DIM = 16
+BLURHASH_COMPONENTS = (4, 3)
+BLURHASH_SAMPLE = 32
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+THUMB_MAX_DIM = 2048
+FFMPEG = shutil.which('ffmpeg')
+FFMPEG_TIMEOUT = 120
+POSTER_SEEK = 1.0
+THUMB_PREVIEWS = False
+PREVIEW_SIZE = (160, 213)
+PREVIEW_SECONDS = 3
+PREVIEW_FPS = 8
+PREVIEW_QUALITY = 60
+THUMB_FORMAT_QUALITY = {'jpeg': THUMB_QUALITY, 'webp': 80, 'avif': 60}
+INDEX_POLL_INTERVAL = 2.0
+INDEX_BULK_CHANGES = 256
+CATALOG_READ_RETRIES = 3
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 16
+RESPONSE_CACHE_SIZE = 512
+COMPRESS_MIN_SIZE = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 9
+TAGS_DB = "crawler.db"
+TAG_INDEX_POLL_INTERVAL = 30.0
+TAG_SET_CACHE_SIZE = 64
+TAG_SUGGEST_LIMIT = 20
+INTERSECT_GALLOP_RATIO = 16
+SEARCH_CACHE_SIZE = 64
+HASH_FILE = "umamusume_thumbs.phash.npz"
+HASH_IMAGE_SIZE = 32
+HASH_BATCH = 512
+HASH_CHUNKS = 4
+HASH_POLL_INTERVAL = 30.0
+SIMILAR_RADIUS = 8
+SIMILAR_MAX_RADIUS = 12
+SIMILAR_LIMIT = 100
+DUPLICATE_RADIUS = 3
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_WINDOW = 1024
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+PROFILER_ENABLED = False
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_DEPTH = 64
+SERVER_ENGINE = "threaded"
+ASYNC_HANDLER_WORKERS = 16
+ASYNC_MAX_CONNECTIONS = 4096
+ASYNC_KEEPALIVE_TIMEOUT = 75
+ASYNC_SEND_TIMEOUT = 60
+ASYNC_MAX_HEADER_BYTES = 64 * 1024
+ASYNC_WRITE_BUFFER_HIGH = 256 * 1024
+
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.webm', '.mp4')
+VIDEO_EXTENSIONS = ('.webm', '.mp4', '.gif')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def sort_key(fname):
+    base = os.path.splitext(fname)[0]
+    return (0, int(base), fname) if base.isdigit() else (1, 0, fname)
+
+def parse_range(header, size):
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for part in header[6:].split(','):
+        part = part.strip()
+        if '-' not in part:
+            return None
+        first, last = part.split('-', 1)
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+            else:
+                length = int(last)
+                if length <= 0:
+                    continue
+                start = max(size - length, 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def thumb_version(folder):
+    if THUMB_STORE is not None:
+        return THUMB_STORE.version
+    return file_mtime(folder)
+
+def entry_meta(meta):
+    meta = meta or {}
+    return {"width": meta.get("width"), "height": meta.get("height"), "size": meta.get("size"),
+            "color": meta.get("color"), "blurhash": meta.get("blurhash")}
+
+class CatalogIndex:
+    def __init__(self, image_folder, thumb_folder, meta_path=THUMB_META):
+        self.image_folder = image_folder
+        self.thumb_folder = thumb_folder
+        self.meta_path = meta_path
+        self.meta = {}
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.keys = []
+        self.entries = []
+        self.by_base = {}
+        self.thumbs = set()
+        self.thumb_count = 0
+        self.version = 0
+        self.last_modified = time.time()
+        self.loaded = False
+        self._present = (None, frozenset())
+        self._image_mtime = None
+        self._thumb_mtime = None
+        self._meta_mtime = None
+        self._watcher = None
+
+    def _make_entry(self, fname):
+        base = fname.rpartition('.')[0] or fname
+        is_video = fname.lower().endswith(VIDEO_EXTENSIONS)
+        thumb_fname = f"{base}.jpg"
+        preview_fname = f"{base}.webp"
+        meta = self.meta.get(fname) or {}
+        return {
+            "name": fname,
+            "url": f"/{self.image_folder}/{fname}",
+            "thumb": f"/{self.thumb_folder}/{thumb_fname}" if thumb_fname in self.thumbs else None,
+            "preview": f"/{self.thumb_folder}/{preview_fname}" if is_video and preview_fname in self.thumbs else None,
+            "isVideo": is_video,
+            "width": meta.get("width"),
+            "height": meta.get("height"),
+            "size": meta.get("size"),
+            "color": meta.get("color"),
+            "blurhash": meta.get("blurhash")
+        }
+
+    def _add_image(self, fname):
+        key = sort_key(fname)
+        pos = bisect.bisect_left(self.keys, key)
+        self.keys.insert(pos, key)
+        self.entries.insert(pos, self._make_entry(fname))
+        self.by_base.setdefault(os.path.splitext(fname)[0], set()).add(fname)
+
+    def _remove_image(self, fname):
+        key = sort_key(fname)
+        pos = bisect.bisect_left(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            del self.keys[pos]
+            del self.entries[pos]
+        base = os.path.splitext(fname)[0]
+        names = self.by_base.get(base)
+        if names is not None:
+            names.discard(fname)
+            if not names:
+                del self.by_base[base]
+
+    def _load_images(self, names):
+        self.keys = sorted(sort_key(fname) for fname in names)
+        self.entries = [self._make_entry(key[2]) for key in self.keys]
+        self.by_base = {}
+        for key in self.keys:
+            self.by_base.setdefault(key[2].rpartition('.')[0] or key[2], set()).add(key[2])
+
+    def _rebuild_entries(self, base):
+        for fname in self.by_base.get(base, ()):
+            pos = bisect.bisect_left(self.keys, sort_key(fname))
+            self.entries[pos] = self._make_entry(fname)
+
+    def _scan(self, folder, extensions=None):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            with os.scandir(folder) as it:
+                names = {e.name for e in it
+                         if e.is_file() and (extensions is None or e.name.lower().endswith(extensions))}
+            return mtime, names
+        except FileNotFoundError:
+            return None, set()
+
+    def refresh(self):
+        with self.refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        try:
+            image_mtime = os.stat(self.image_folder).st_mtime_ns
+        except FileNotFoundError:
+            image_mtime = None
+        thumb_mtime = thumb_version(self.thumb_folder)
+        meta_mtime = file_mtime(self.meta_path)
+
+        if (self.loaded and image_mtime == self._image_mtime and thumb_mtime == self._thumb_mtime
+                and meta_mtime == self._meta_mtime):
+            return False
+
+        meta = None
+        if meta_mtime != self._meta_mtime:
+            meta = load_manifest(self.meta_path)
+
+        thumb_changes = None
+        if not self.loaded or thumb_mtime != self._thumb_mtime:
+            if THUMB_STORE is not None:
+                thumb_mtime, thumb_names = THUMB_STORE.scan(('.jpg', '.webp'))
+                thumb_names = set(thumb_names)
+            else:
+                thumb_mtime, thumb_names = self._scan(self.thumb_folder, ('.jpg', '.webp'))
+            thumb_changes = (thumb_names - self.thumbs, self.thumbs - thumb_names)
+
+        image_changes = None
+        if not self.loaded or image_mtime != self._image_mtime:
+            image_mtime, image_names = self._scan(self.image_folder, MEDIA_EXTENSIONS)
+            current = {e["name"] for e in self.entries}
+            image_changes = (image_names - current, current - image_names, image_names)
+
+        changed = False
+        with self.lock:
+            if meta is not None:
+                stale = {n for n in meta.keys() | self.meta.keys() if meta.get(n) != self.meta.get(n)}
+                self.meta = meta
+                for fname in stale:
+                    self._rebuild_entries(os.path.splitext(fname)[0])
+                changed |= bool(stale)
+            if thumb_changes is not None:
+                added, removed = thumb_changes
+                self.thumbs |= added
+                self.thumbs -= removed
+                self.thumb_count += (sum(1 for n in added if n.endswith('.jpg'))
+                                     - sum(1 for n in removed if n.endswith('.jpg')))
+                if self.loaded:
+                    for thumb in added | removed:
+                        self._rebuild_entries(os.path.splitext(thumb)[0])
+                changed |= bool(added or removed)
+            if image_changes is not None:
+                added, removed, image_names = image_changes
+                if not self.loaded or len(added) + len(removed) > INDEX_BULK_CHANGES:
+                    self._load_images(image_names)
+                else:
+                    for fname in removed:
+                        self._remove_image(fname)
+                    for fname in added:
+                        self._add_image(fname)
+                changed |= bool(added or removed)
+            self._image_mtime = image_mtime
+            self._thumb_mtime = thumb_mtime
+            self._meta_mtime = meta_mtime
+            if changed or not self.loaded:
+                self.version += 1
+                mtimes = [m for m in (image_mtime, thumb_mtime) if m is not None]
+                self.last_modified = max(mtimes) / 1e9 if mtimes else time.time()
+            self.loaded = True
+        return changed
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    def page(self, page, per_page=PAGE_SIZE):
+        return self.slice(max(page - 1, 0) * per_page, per_page)
+
+    def slice(self, start, count):
+        self.ensure_loaded()
+        with self.lock:
+            return self.entries[start:start + count]
+
+    def counts(self):
+        self.ensure_loaded()
+        with self.lock:
+            return len(self.entries), self.thumb_count
+
+    def present_ids(self):
+        self.ensure_loaded()
+        with self.lock:
+            if self._present[0] != self.version:
+                self._present = (self.version, frozenset(int(b) for b in self.by_base if b.isdigit()))
+            return self._present[1]
+
+    def entries_for(self, bases):
+        self.ensure_loaded()
+        with self.lock:
+            result = []
+            for base in bases:
+                for fname in sorted(self.by_base.get(base, ()), key=sort_key):
+                    result.append(self.entries[bisect.bisect_left(self.keys, sort_key(fname))])
+            return result
+
+    def positions_for(self, bases):
+        self.ensure_loaded()
+        with self.lock:
+            return sorted(bisect.bisect_left(self.keys, sort_key(fname))
+                          for base in bases for fname in self.by_base.get(base, ()))
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+    def start_watcher(self, interval=INDEX_POLL_INTERVAL):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+
+class ShardedCatalog:
+    def __init__(self, folder, image_folder, thumb_folder, meta_path=THUMB_META):
+        self.folder = folder
+        self.image_folder = image_folder
+        self.thumb_folder = thumb_folder
+        self.meta_path = meta_path
+        self.meta = {}
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.shards = []
+        self.starts = []
+        self.log_lines = []
+        self.total = 0
+        self.thumb_count = 0
+        self.version = 0
+        self.last_modified = time.time()
+        self.loaded = False
+        self._manifest_mtime = None
+        self._meta_mtime = None
+        self._log_file = "log.jsonl"
+        self._log_size = None
+        self._by_base = None
+        self._present = (None, frozenset())
+        self._shard_ids = (None, frozenset())
+        self._watcher = None
+
+    def _open_shard(self, shard):
+        with open(os.path.join(self.folder, shard["file"]), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = array('Q')
+        with open(os.path.join(self.folder, shard["index"]), 'rb') as f:
+            offsets.frombytes(f.read())
+        return {"file": shard["file"], "count": shard["count"], "thumbs": shard["thumbs"],
+                "mmap": mm, "offsets": offsets}
+
+    def _make_entry(self, line):
+        item = json.loads(line)
+        fname = item["name"]
+        base = os.path.splitext(fname)[0]
+        return dict({
+            "name": fname,
+            "url": f"/{self.image_folder}/{fname}",
+            "thumb": f"/{self.thumb_folder}/{base}.jpg" if item.get("thumb") else None,
+            "preview": None,
+            "isVideo": fname.lower().endswith(VIDEO_EXTENSIONS)
+        }, **entry_meta(self.meta.get(fname)))
+
+    def refresh(self):
+        with self.refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        manifest_path = os.path.join(self.folder, "manifest.json")
+        meta_mtime = file_mtime(self.meta_path)
+        for _ in range(CATALOG_READ_RETRIES):
+            manifest_mtime = file_mtime(manifest_path)
+            manifest = None
+            log_file = self._log_file
+            if manifest_mtime != self._manifest_mtime:
+                try:
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    manifest = {"shards": []}
+                log_file = manifest.get("log", {}).get("file", "log.jsonl")
+            log_path = os.path.join(self.folder, log_file)
+            try:
+                log_size = os.stat(log_path).st_size
+            except FileNotFoundError:
+                log_size = 0
+
+            if (self.loaded and manifest_mtime == self._manifest_mtime and log_size == self._log_size
+                    and meta_mtime == self._meta_mtime):
+                return False
+
+            log_lines = []
+            try:
+                with open(log_path, 'rb') as f:
+                    log_lines = [line for line in f if line.endswith(b'\n')]
+            except FileNotFoundError:
+                pass
+            if file_mtime(manifest_path) == manifest_mtime:
+                break
+
+        meta = self.meta
+        if meta_mtime != self._meta_mtime:
+            meta = load_manifest(self.meta_path)
+
+        shards = self.shards
+        if manifest is not None:
+            opened = {s["file"]: s for s in self.shards}
+            shards = [opened.get(s["file"]) or self._open_shard(s) for s in manifest["shards"]]
+
+        with self.lock:
+            self.shards = shards
+            self.starts = []
+            total = 0
+            for shard in shards:
+                self.starts.append(total)
+                total += shard["count"]
+            self.log_lines = log_lines
+            self.total = total + len(log_lines)
+            self.thumb_count = (sum(s["thumbs"] for s in shards)
+                                + sum(1 for line in log_lines if b'"thumb":null' not in line))
+            self._manifest_mtime = manifest_mtime
+            self._meta_mtime = meta_mtime
+            self._log_file = log_file
+            self._log_size = log_size
+            self.meta = meta
+            self._by_base = None
+            self.version += 1
+            self.last_modified = time.time()
+            self.loaded = True
+        return True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    def page(self, page, per_page=PAGE_SIZE):
+        return self.slice(max(page - 1, 0) * per_page, per_page)
+
+    def slice(self, start, count):
+        self.ensure_loaded()
+        end = start + count
+        lines = []
+        with self.lock:
+            pos = max(bisect.bisect_right(self.starts, start) - 1, 0)
+            while pos < len(self.shards) and len(lines) < count:
+                shard = self.shards[pos]
+                first = max(start - self.starts[pos], 0)
+                last = min(end - self.starts[pos], shard["count"])
+                if first < last:
+                    offsets = shard["offsets"]
+                    lines.extend(shard["mmap"][offsets[first]:offsets[last]].splitlines())
+                pos += 1
+            log_start = sum(s["count"] for s in self.shards)
+            if end > log_start:
+                lines.extend(self.log_lines[max(start - log_start, 0):end - log_start])
+        return [self._make_entry(line) for line in lines]
+
+    def counts(self):
+        self.ensure_loaded()
+        with self.lock:
+            return self.total, self.thumb_count
+
+    def _shard_bases(self, shard):
+        bases = shard.get("bases")
+        if bases is None:
+            bases = {}
+            mm = shard["mmap"]
+            offsets = shard["offsets"]
+            prefix = b'{"name":"'
+            for row in range(shard["count"]):
+                start, end = offsets[row], offsets[row + 1]
+                stop = mm.find(b'"', start + len(prefix), end)
+                if stop > 0 and mm[start:start + len(prefix)] == prefix and b'\\' not in mm[start:stop]:
+                    name = mm[start + len(prefix):stop].decode('utf-8')
+                else:
+                    name = json.loads(mm[start:end])["name"]
+                bases[os.path.splitext(name)[0]] = row
+            shard["bases"] = bases
+        return bases
+
+    def _base_index(self):
+        with self.lock:
+            if self._by_base is None:
+                self._by_base = {}
+                for row, line in enumerate(self.log_lines):
+                    self._by_base[os.path.splitext(json.loads(line)["name"])[0]] = row
+            return self.shards, self.starts, self.log_lines, self._by_base
+
+    def _locate(self, bases):
+        shards, starts, log_lines, log_bases = self._base_index()
+        log_start = starts[-1] + shards[-1]["count"] if shards else 0
+        found = []
+        for base in bases:
+            row = log_bases.get(base)
+            if row is not None:
+                found.append((log_start + row, log_lines[row]))
+                continue
+            for pos in range(len(shards) - 1, -1, -1):
+                row = self._shard_bases(shards[pos]).get(base)
+                if row is not None:
+                    offsets = shards[pos]["offsets"]
+                    found.append((starts[pos] + row, shards[pos]["mmap"][offsets[row]:offsets[row + 1]]))
+                    break
+        return found
+
+    def present_ids(self):
+        self.ensure_loaded()
+        shards, _, _, log_bases = self._base_index()
+        key = tuple(s["file"] for s in shards)
+        shard_ids = self._shard_ids
+        if shard_ids[0] != key:
+            ids = set()
+            for shard in shards:
+                ids.update(int(b) for b in self._shard_bases(shard) if b.isdigit())
+            self._shard_ids = shard_ids = (key, frozenset(ids))
+        with self.lock:
+            if self._present[0] is not log_bases:
+                log_ids = {int(b) for b in log_bases if b.isdigit()}
+                self._present = (log_bases, shard_ids[1] | log_ids)
+            return self._present[1]
+
+    def entries_for(self, bases):
+        self.ensure_loaded()
+        return [self._make_entry(line) for _, line in self._locate(bases)]
+
+    def positions_for(self, bases):
+        self.ensure_loaded()
+        return sorted(pos for pos, _ in self._locate(bases))
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+    def start_watcher(self, interval=INDEX_POLL_INTERVAL):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+
+CATALOG = CatalogIndex(IMAGE_FOLDER, THUMB_FOLDER)
+
+class TagIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.names = []
+        self.tag_ids = {}
+        self.postings = []
+        self.all_ids = array('I')
+        self.version = 0
+        self.loaded = False
+        self._mtime = None
+        self._retry_at = 0.0
+        self._sets = OrderedDict()
+        self._watcher = None
+
+    def _db_mtime(self):
+        mtimes = []
+        for path in (self.db_path, f"{self.db_path}-wal"):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        return max(mtimes) if mtimes else None
+
+    def refresh(self):
+        with self.refresh_lock:
+            mtime = self._db_mtime()
+            if self.loaded and mtime == self._mtime:
+                return False
+
+            postings = {}
+            all_ids = array('I')
+            if mtime is not None:
+                try:
+                    conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                    try:
+                        rows = conn.execute("SELECT id, tags FROM posts WHERE tags IS NOT NULL AND tags != '' ORDER BY id")
+                        for post_id, tags in rows:
+                            all_ids.append(post_id)
+                            for tag in tags.split():
+                                ids = postings.get(tag)
+                                if ids is None:
+                                    ids = postings[sys.intern(tag)] = array('I')
+                                if not ids or ids[-1] != post_id:
+                                    ids.append(post_id)
+                    finally:
+                        conn.close()
+                except sqlite3.Error:
+                    self._retry_at = time.monotonic() + TAG_INDEX_POLL_INTERVAL
+                    return False
+
+            names = sorted(postings)
+            with self.lock:
+                self.names = names
+                self.tag_ids = {name: i for i, name in enumerate(names)}
+                self.postings = [postings[name] for name in names]
+                self.all_ids = all_ids
+                self._sets.clear()
+                self._mtime = mtime
+                self.version += 1
+                self.loaded = True
+            return True
+
+    def ensure_loaded(self):
+        if not self.loaded and time.monotonic() >= self._retry_at:
+            self.refresh()
+
+    def _member_set(self, tag_id):
+        members = self._sets.get(tag_id)
+        if members is None:
+            members = frozenset(self.postings[tag_id])
+            self._sets[tag_id] = members
+            while len(self._sets) > TAG_SET_CACHE_SIZE:
+                self._sets.popitem(last=False)
+        else:
+            self._sets.move_to_end(tag_id)
+        return members
+
+    def _filter(self, ids, tag_id, keep):
+        postings = self.postings[tag_id]
+        if len(ids) * INTERSECT_GALLOP_RATIO < len(postings):
+            result = array('I')
+            lo, size = 0, len(postings)
+            for post_id in ids:
+                lo = bisect.bisect_left(postings, post_id, lo)
+                if (lo < size and postings[lo] == post_id) == keep:
+                    result.append(post_id)
+            return result
+        members = self._member_set(tag_id)
+        if keep:
+            return array('I', [post_id for post_id in ids if post_id in members])
+        return array('I', [post_id for post_id in ids if post_id not in members])
+
+    def search(self, include, exclude=()):
+        self.ensure_loaded()
+        with self.lock:
+            include_ids = []
+            for tag in include:
+                tag_id = self.tag_ids.get(tag)
+                if tag_id is None:
+                    return array('I')
+                include_ids.append(tag_id)
+            exclude_ids = [self.tag_ids[tag] for tag in exclude if tag in self.tag_ids]
+            
+            include_ids.sort(key=lambda i: len(self.postings[i]))
+            ids = self.postings[include_ids[0]] if include_ids else self.all_ids
+            for tag_id in include_ids[1:]:
+                ids = self._filter(ids, tag_id, True)
+                if not ids:
+                    break
+            for tag_id in exclude_ids:
+                if not ids:
+                    break
+                ids = self._filter(ids, tag_id, False)
+            return ids
+
+    def suggest(self, prefix, limit=TAG_SUGGEST_LIMIT):
+        self.ensure_loaded()
+        with self.lock:
+            lo = bisect.bisect_left(self.names, prefix)
+            hi = bisect.bisect_left(self.names, prefix + '\U0010ffff')
+            top = heapq.nlargest(limit, range(lo, hi), key=lambda i: len(self.postings[i]))
+            return [{"tag": self.names[i], "count": len(self.postings[i])} for i in top]
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+    def start_watcher(self, interval=TAG_INDEX_POLL_INTERVAL):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+
+TAG_INDEX = TagIndex(TAGS_DB)
+THUMB_PROGRESS = {"total": 0, "done": 0, "failed": 0, "started": None}
+
+def supported_thumb_formats():
+    Image.init()
+    return [fmt for fmt in ('avif', 'webp', 'jpeg') if fmt.upper() in Image.SAVE]
+
+def negotiate_thumb_format(requested, accept):
+    formats = supported_thumb_formats()
+    if requested:
+        return requested if requested in formats else None
+    accept = (accept or '').lower()
+    for fmt in formats:
+        if fmt == 'jpeg' or f'image/{fmt}' in accept:
+            return fmt
+    return 'jpeg'
+
+class ThumbCache:
+    def __init__(self, folder, max_bytes=THUMB_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.pending = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _load(self):
+        os.makedirs(self.folder, exist_ok=True)
+        files = []
+        with os.scandir(self.folder) as it:
+            for e in it:
+                if e.is_file() and not e.name.endswith('.tmp'):
+                    st = e.stat()
+                    files.append((st.st_mtime, e.name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self.loaded = True
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+    def key(self, src_path, width, height, fmt):
+        st = os.stat(src_path)
+        raw = f"{src_path}:{st.st_size}:{st.st_mtime_ns}:{width}x{height}:{fmt}:{THUMB_FORMAT_QUALITY[fmt]}"
+        return f"{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]}.{'jpg' if fmt == 'jpeg' else fmt}"
+
+    def get(self, src_path, width, height, fmt):
+        name = self.key(src_path, width, height, fmt)
+        path = os.path.join(self.folder, name)
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return path
+            event = self.pending.get(name)
+            owner = event is None
+            if owner:
+                event = self.pending[name] = threading.Event()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        
+        if not owner:
+            event.wait()
+            with self.lock:
+                return path if name in self.entries else None
+        
+        try:
+            img = load_thumb_image(src_path, (width, height))
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, fmt.upper(), quality=THUMB_FORMAT_QUALITY[fmt])
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.entries[name] = size
+                self.total_bytes += size
+                self._evict()
+            return path
+        except Exception:
+            return None
+        finally:
+            with self.lock:
+                del self.pending[name]
+            event.set()
+
+THUMB_CACHE = ThumbCache(THUMB_CACHE_FOLDER)
+
+class ThumbPackStore:
+    def __init__(self, folder, max_bytes=THUMB_PACK_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.by_cursor = {}
+        self.total_bytes = 0
+        self.pending = {}
+        self.prefetching = set()
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=THUMB_PACK_PREFETCH_WORKERS)
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._prebuilt = None
+        self._watcher = None
+
+    def _load(self):
+        os.makedirs(self.folder, exist_ok=True)
+        files = []
+        with os.scandir(self.folder) as it:
+            for e in it:
+                if e.is_file() and e.name.endswith('.pack'):
+                    st = e.stat()
+                    files.append((st.st_mtime, e.name, st.st_size))
+        for _, name, size in sorted(files):
+            self._track(name, size)
+        self.loaded = True
+        self._evict()
+
+    def _track(self, name, size):
+        cursor = int(name.split('-', 1)[0])
+        stale = self.by_cursor.get(cursor)
+        if stale is not None and stale != name:
+            self._drop(stale)
+        self.by_cursor[cursor] = name
+        self.entries[name] = size
+        self.total_bytes += size
+
+    def _drop(self, name):
+        size = self.entries.pop(name, None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        cursor = int(name.split('-', 1)[0])
+        if self.by_cursor.get(cursor) == name:
+            del self.by_cursor[cursor]
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self._drop(next(iter(self.entries)))
 
-def generate_thumbs():
+    def members(self, cursor):
+        members = []
+        for entry in CATALOG.slice(cursor, PAGE_SIZE):
+            path = stat = None
+            if entry["thumb"]:
+                path = os.path.join(THUMB_FOLDER, f"{os.path.splitext(entry['name'])[0]}.jpg")
+                stat = stat_thumb(path)
+                if stat is None:
+                    path = None
+            members.append((entry, path, stat))
+        return members
+
+    def key(self, cursor, members):
+        raw = json.dumps([cursor, [(entry, stat) for entry, _, stat in members]], sort_keys=True)
+        return f"{cursor}-{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]}.pack"
+
+    def _write(self, path, cursor, members):
+        items = []
+        blobs = []
+        offset = 0
+        for entry, thumb_path, _ in members:
+            data = b''
+            if thumb_path:
+                try:
+                    with open_thumb(thumb_path) as f:
+                        data = f.read()
+                except OSError:
+                    pass
+            items.append(dict(entry, offset=offset, length=len(data)))
+            blobs.append(data)
+            offset += len(data)
+        header = json.dumps({
+            "cursor": cursor,
+            "next": cursor + len(items) if len(items) == PAGE_SIZE else None,
+            "items": items
+        }, ensure_ascii=False).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(THUMB_PACK_MAGIC + len(header).to_bytes(4, 'little') + header)
+            for data in blobs:
+                f.write(data)
+
+    def get(self, cursor, members=None):
+        if members is None:
+            members = self.members(cursor)
+        name = self.key(cursor, members)
+        path = os.path.join(self.folder, name)
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return path
+            event = self.pending.get(name)
+            owner = event is None
+            if owner:
+                event = self.pending[name] = threading.Event()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            event.wait()
+            with self.lock:
+                return path if name in self.entries else None
+
+        try:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            self._write(tmp_path, cursor, members)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self._track(name, size)
+                self._evict()
+            return path
+        except Exception:
+            return None
+        finally:
+            with self.lock:
+                del self.pending[name]
+            event.set()
+
+    def prefetch(self, cursor):
+        total, _ = CATALOG.counts()
+        if cursor >= total:
+            return
+        members = self.members(cursor)
+        name = self.key(cursor, members)
+        with self.lock:
+            if name in self.entries or name in self.pending or name in self.prefetching:
+                return
+            self.prefetching.add(name)
+        self.prefetch_pool.submit(self._prefetch, cursor, members, name)
+
+    def _prefetch(self, cursor, members, name):
+        try:
+            self.get(cursor, members)
+        finally:
+            with self.lock:
+                self.prefetching.discard(name)
+
+    def prebuild(self, pages=THUMB_PACK_PREBUILD):
+        total, _ = CATALOG.counts()
+        for cursor in range(0, min(total, pages * PAGE_SIZE), PAGE_SIZE):
+            self.get(cursor)
+
+    def _watch(self, interval):
+        while True:
+            try:
+                CATALOG.ensure_loaded()
+                version = CATALOG.version
+                if version != self._prebuilt:
+                    self.prebuild()
+                    self._prebuilt = version
+            except Exception:
+                pass
+            time.sleep(interval)
+
+    def start_watcher(self, interval=THUMB_PACK_POLL_INTERVAL):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+
+THUMB_PACKS = ThumbPackStore(THUMB_PACK_FOLDER)
+
+class PackedThumbStore:
+    def __init__(self, folder, segment_bytes=THUMB_SEGMENT_BYTES):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.index_path = os.path.join(folder, "index.bin")
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.entries = {}
+        self.maps = {}
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.version = 0
+        self.loaded = False
+        self._index = None
+        self._segment = 0
+        self._segment_file = None
+        self._segment_size = 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.folder, f"segment-{segment:05d}.dat")
+
+    def _segments_on_disk(self):
+        segments = []
+        with os.scandir(self.folder) as it:
+            for e in it:
+                if e.name.startswith('segment-') and e.name.endswith('.dat'):
+                    try:
+                        segments.append(int(e.name[8:-4]))
+                    except ValueError:
+                        pass
+        return segments
+
+    def _read_index(self):
+        entries = {}
+        dead = 0
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        pos = 0
+        while pos + THUMB_STORE_RECORD.size <= len(data):
+            name_len, segment, offset, length, mtime = THUMB_STORE_RECORD.unpack_from(data, pos)
+            end = pos + THUMB_STORE_RECORD.size + name_len
+            if end > len(data):
+                break
+            name = data[pos + THUMB_STORE_RECORD.size:end].decode('utf-8')
+            old = entries.pop(name, None)
+            if old is not None:
+                dead += old[2]
+            if segment != THUMB_STORE_TOMBSTONE:
+                entries[name] = (segment, offset, length, mtime)
+            pos = end
+        return entries, dead, pos
+
+    def load(self):
+        os.makedirs(self.folder, exist_ok=True)
+        entries, dead, valid = self._read_index()
+        sizes = {}
+        for segment in self._segments_on_disk():
+            sizes[segment] = os.path.getsize(self._segment_path(segment))
+        entries = {name: e for name, e in entries.items() if e[1] + e[2] <= sizes.get(e[0], -1)}
+        referenced = {e[0] for e in entries.values()}
+        active = max(referenced, default=0)
+        for segment in sizes:
+            if segment not in referenced and segment != active:
+                try:
+                    os.remove(self._segment_path(segment))
+                except OSError:
+                    pass
+        with self.lock:
+            self.entries = entries
+            self.maps = {}
+            self.live_bytes = sum(e[2] for e in entries.values())
+            self.dead_bytes = dead
+            self._index = open(self.index_path, 'ab')
+            self._index.truncate(valid)
+            self._open_segment(active)
+            self.version += 1
+            self.loaded = True
+
+    def _open_segment(self, segment):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment = segment
+        self._segment_file = open(self._segment_path(segment), 'ab')
+        self._segment_size = self._segment_file.tell()
+
+    def _record(self, name, segment, offset, length, mtime):
+        raw = name.encode('utf-8')
+        return THUMB_STORE_RECORD.pack(len(raw), segment, offset, length, mtime) + raw
+
+    def _map(self, segment, end):
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < end:
+            with open(self._segment_path(segment), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mm
+        return mm
+
+    def put(self, name, data, mtime=None):
+        mtime = mtime or time.time_ns()
+        with self.lock:
+            if self._segment_size and self._segment_size + len(data) > self.segment_bytes:
+                self._open_segment(self._segment + 1)
+            offset = self._segment_size
+            self._segment_file.write(data)
+            self._segment_file.flush()
+            self._segment_size += len(data)
+            self._index.write(self._record(name, self._segment, offset, len(data), mtime))
+            self._index.flush()
+            old = self.entries.get(name)
+            if old is not None:
+                self.live_bytes -= old[2]
+                self.dead_bytes += old[2]
+            self.entries[name] = (self._segment, offset, len(data), mtime)
+            self.live_bytes += len(data)
+            self.version += 1
+
+    def delete(self, name):
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is None:
+                return False
+            self._index.write(self._record(name, THUMB_STORE_TOMBSTONE, 0, 0, 0))
+            self._index.flush()
+            self.live_bytes -= old[2]
+            self.dead_bytes += old[2]
+            self.version += 1
+            return True
+
+    def view(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            segment, offset, length, mtime = entry
+            if not length:
+                return memoryview(b''), mtime
+            mm = self._map(segment, offset + length)
+        return memoryview(mm)[offset:offset + length], mtime
+
+    def read(self, name):
+        found = self.view(name)
+        return bytes(found[0]) if found is not None else None
+
+    def stat(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+        return (entry[2], entry[3]) if entry is not None else None
+
+    def scan(self, extensions=None):
+        with self.lock:
+            return self.version, {n: e[3] for n, e in self.entries.items()
+                                  if extensions is None or n.endswith(extensions)}
+
+    def import_folder(self, folder):
+        try:
+            with os.scandir(folder) as it:
+                files = [e for e in it if e.is_file() and e.name.endswith(('.jpg', '.webp'))]
+        except FileNotFoundError:
+            return 0
+        for i, e in enumerate(files, 1):
+            self.ingest(e.path)
+            if i % 10000 == 0 or i == len(files):
+                print(f"📦 Превью в хранилище: {i}/{len(files)}", flush=True)
+        return len(files)
+
+    def ingest(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+        except OSError:
+            return False
+        self.put(os.path.basename(path), data, mtime)
+        os.remove(path)
+        return True
+
+    def compact(self):
+        with self.compact_lock:
+            with self.lock:
+                snapshot = dict(self.entries)
+                first = max(self._segments_on_disk() + [self._segment]) + 1
+                moved = {}
+                segment, size = first, 0
+                for name, (_, _, length, mtime) in snapshot.items():
+                    if size and size + length > self.segment_bytes:
+                        segment += 1
+                        size = 0
+                    moved[name] = (segment, size, length, mtime)
+                    size += length
+                self._open_segment(segment + 1)
+                reclaimed = self.dead_bytes
+
+            out = None
+            try:
+                for name, (segment, offset, length, mtime) in moved.items():
+                    if out is None or out.name != self._segment_path(segment):
+                        if out is not None:
+                            out.close()
+                        out = open(self._segment_path(segment), 'wb')
+                    old_segment, old_offset, _, _ = snapshot[name]
+                    if length:
+                        with self.lock:
+                            mm = self._map(old_segment, old_offset + length)
+                        out.write(memoryview(mm)[old_offset:old_offset + length])
+            finally:
+                if out is not None:
+                    out.close()
+
+            with self.lock:
+                for name, entry in moved.items():
+                    if self.entries.get(name) == snapshot[name]:
+                        self.entries[name] = entry
+                tmp_path = f"{self.index_path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    for name, entry in self.entries.items():
+                        f.write(self._record(name, *entry))
+                self._index.close()
+                os.replace(tmp_path, self.index_path)
+                self._index = open(self.index_path, 'ab')
+                referenced = {e[0] for e in self.entries.values()} | {self._segment}
+                on_disk = 0
+                for s in self._segments_on_disk():
+                    if s in referenced:
+                        on_disk += os.path.getsize(self._segment_path(s))
+                        continue
+                    self.maps.pop(s, None)
+                    try:
+                        os.remove(self._segment_path(s))
+                    except OSError:
+                        pass
+                self.live_bytes = sum(e[2] for e in self.entries.values())
+                self.dead_bytes = max(on_disk - self.live_bytes, 0)
+                self.version += 1
+            return reclaimed
+
+    def maybe_compact(self, ratio=THUMB_STORE_COMPACT_RATIO, minimum=THUMB_STORE_COMPACT_MIN):
+        total = self.live_bytes + self.dead_bytes
+        if self.dead_bytes >= minimum and self.dead_bytes > ratio * total:
+            reclaimed = self.compact()
+            print(f"📦 Хранилище превью сжато: освобождено {reclaimed / 1024 / 1024:.1f} МБ", flush=True)
+            return True
+        return False
+
+THUMB_STORE = None
+
+def open_thumb(path):
+    if THUMB_STORE is not None and os.path.dirname(path) == THUMB_FOLDER:
+        data = THUMB_STORE.read(os.path.basename(path))
+        if data is None:
+            raise FileNotFoundError(path)
+        return io.BytesIO(data)
+    return open(path, 'rb')
+
+def stat_thumb(path):
+    if THUMB_STORE is not None and os.path.dirname(path) == THUMB_FOLDER:
+        return THUMB_STORE.stat(os.path.basename(path))
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def remove_thumb(path):
+    if THUMB_STORE is not None and os.path.dirname(path) == THUMB_FOLDER:
+        THUMB_STORE.delete(os.path.basename(path))
+        return
+    os.remove(path)
+
+class CachedResponse:
+    def __init__(self, body, content_type, last_modified):
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.bodies = {None: body}
+
+    def get(self, encoding):
+        body = self.bodies.get(encoding)
+        if body is None:
+            raw = self.bodies[None]
+            if encoding == 'br':
+                body = brotli.compress(raw, quality=BROTLI_QUALITY)
+            else:
+                body = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+            self.bodies[encoding] = body
+        etag = f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"'
+        return body, etag
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = build()
+        with self.lock:
+            if version == self.version:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+RESPONSE_CACHE = ResponseCache()
+SEARCH_CACHE = ResponseCache(SEARCH_CACHE_SIZE)
+
+def negotiate_encoding(accept_encoding, size):
+    if not accept_encoding or size < COMPRESS_MIN_SIZE:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def load_thumb_image(src_path, size):
+    with Image.open(src_path) as img:
+        img.draft(None, (size[0] * 2, size[1] * 2))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background.convert('RGB')
+        else:
+            img = img.convert('RGB')
+        
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        return img
+
+def extract_video_frame(src_path):
+    for seek in (POSTER_SEEK, 0):
+        result = subprocess.run([FFMPEG, '-v', 'error', '-ss', str(seek), '-i', src_path,
+                                 '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+                                capture_output=True, timeout=FFMPEG_TIMEOUT)
+        if result.returncode == 0 and result.stdout:
+            return io.BytesIO(result.stdout)
+    raise ValueError(f"No video frame in {src_path}")
+
+def render_preview(src_path, preview_path):
+    tmp_path = f"{preview_path}.tmp"
+    if src_path.lower().endswith('.gif'):
+        frames, durations = [], []
+        with Image.open(src_path) as img:
+            for frame in ImageSequence.Iterator(img):
+                frame = frame.convert('RGB')
+                frame.thumbnail(PREVIEW_SIZE, Image.Resampling.LANCZOS)
+                frames.append(frame)
+                durations.append(frame.info.get('duration') or img.info.get('duration') or 100)
+                if sum(durations) >= PREVIEW_SECONDS * 1000:
+                    break
+        frames[0].save(tmp_path, "WEBP", save_all=True, append_images=frames[1:],
+                       duration=durations, loop=0, quality=PREVIEW_QUALITY)
+    else:
+        subprocess.run([FFMPEG, '-v', 'error', '-y', '-t', str(PREVIEW_SECONDS), '-i', src_path,
+                        '-vf', f"fps={PREVIEW_FPS},scale={PREVIEW_SIZE[0]}:{PREVIEW_SIZE[1]}:force_original_aspect_ratio=decrease",
+                        '-an', '-loop', '0', '-c:v', 'libwebp', '-q:v', str(PREVIEW_QUALITY), '-f', 'webp', tmp_path],
+                       capture_output=True, timeout=FFMPEG_TIMEOUT, check=True)
+    os.replace(tmp_path, preview_path)
+
+def render_thumb(src_path, thumb_path):
+    lower = src_path.lower()
+    try:
+        source = extract_video_frame(src_path) if lower.endswith(('.mp4', '.webm')) else src_path
+        width, height = source_size(source)
+        img = load_thumb_image(source, THUMB_SIZE)
+        img.save(thumb_path, "JPEG", quality=THUMB_QUALITY, optimize=True)
+        meta = thumb_meta(img, width, height)
+    except Exception:
+        return None
+    if THUMB_PREVIEWS and lower.endswith(VIDEO_EXTENSIONS):
+        try:
+            render_preview(src_path, f"{os.path.splitext(thumb_path)[0]}.webp")
+        except Exception:
+            pass
+    return meta
+
+def encode83(value, length):
+    return ''.join(BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length))
+
+def srgb_to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+def linear_to_srgb(value):
+    v = min(max(value, 0.0), 1.0)
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def blurhash(img, components=BLURHASH_COMPONENTS):
+    cx, cy = components
+    w = h = BLURHASH_SAMPLE
+    data = img.convert('RGB').resize((w, h), Image.Resampling.BILINEAR).tobytes()
+    linear = [tuple(srgb_to_linear(c) for c in data[k:k + 3]) for k in range(0, len(data), 3)]
+    cos_x = [[math.cos(math.pi * i * x / w) for x in range(w)] for i in range(cx)]
+    cos_y = [[math.cos(math.pi * j * y / h) for y in range(h)] for j in range(cy)]
+    rows = []
+    for y in range(h):
+        row = linear[y * w:(y + 1) * w]
+        rows.append([[sum(cos_x[i][x] * row[x][c] for x in range(w)) for c in range(3)] for i in range(cx)])
+    factors = []
+    for j in range(cy):
+        for i in range(cx):
+            scale = (1 if i == j == 0 else 2) / (w * h)
+            factors.append([scale * sum(cos_y[j][y] * rows[y][i][c] for y in range(h)) for c in range(3)])
+
+    dc, ac = factors[0], factors[1:]
+    result = encode83((cx - 1) + (cy - 1) * 9, 1)
+    if ac:
+        quantised = int(max(0, min(82, math.floor(max(abs(v) for f in ac for v in f) * 166 - 0.5))))
+        maximum = (quantised + 1) / 166
+    else:
+        quantised, maximum = 0, 1
+    result += encode83(quantised, 1)
+    result += encode83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for f in ac:
+        q = [int(max(0, min(18, math.floor(math.copysign(abs(v / maximum) ** 0.5, v) * 9 + 9.5)))) for v in f]
+        result += encode83(q[0] * 19 * 19 + q[1] * 19 + q[2], 2)
+    return result
+
+def dominant_color(img):
+    small = img.convert('RGB').resize((BLURHASH_SAMPLE, BLURHASH_SAMPLE), Image.Resampling.BILINEAR)
+    palette = small.quantize(colors=4)
+    _, index = max(palette.getcolors())
+    r, g, b = palette.getpalette()[index * 3:index * 3 + 3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def thumb_meta(img, width, height):
+    return {"width": width, "height": height, "color": dominant_color(img), "blurhash": blurhash(img)}
+
+def source_size(source):
+    with Image.open(source) as img:
+        size = img.size
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return size
+
+def describe_thumb(src_path, thumb_data):
+    try:
+        if src_path.lower().endswith(('.mp4', '.webm')):
+            width, height = source_size(extract_video_frame(src_path))
+        else:
+            width, height = source_size(src_path)
+        with Image.open(io.BytesIO(thumb_data)) as img:
+            return thumb_meta(img, width, height)
+    except Exception:
+        return None
+
+def describe_thumbs(executor, src_paths, thumb_paths):
+    for start in range(0, len(src_paths), DESCRIBE_BATCH):
+        thumbs = []
+        for path in thumb_paths[start:start + DESCRIBE_BATCH]:
+            try:
+                with open_thumb(path) as f:
+                    thumbs.append(f.read())
+            except OSError:
+                thumbs.append(None)
+        yield from executor.map(describe_thumb, src_paths[start:start + DESCRIBE_BATCH], thumbs, chunksize=16)
+
+def poster_extensions():
+    return IMAGE_EXTENSIONS + (VIDEO_EXTENSIONS if FFMPEG else ('.gif',))
+
+def thumb_fingerprint(video=False):
+    params = [THUMB_PIPELINE_VERSION, THUMB_SIZE, THUMB_QUALITY]
+    if video:
+        params += [POSTER_SEEK, THUMB_PREVIEWS, PREVIEW_SIZE, PREVIEW_SECONDS, PREVIEW_FPS, PREVIEW_QUALITY]
+    raw = json.dumps(params)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+def load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('entries', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+def save_manifest(path, entries):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"entries": entries}, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def source_stamp(folder):
+    try:
+        names = sorted(n for n in os.listdir(folder) if n.lower().endswith(MEDIA_EXTENSIONS))
+    except FileNotFoundError:
+        return None
+    stamps = array('q')
+    fd = os.open(folder, os.O_RDONLY) if os.stat in os.supports_dir_fd else None
+    try:
+        for name in names:
+            try:
+                st = os.stat(name, dir_fd=fd) if fd is not None else os.stat(os.path.join(folder, name))
+            except FileNotFoundError:
+                continue
+            stamps.append(st.st_size)
+            stamps.append(st.st_mtime_ns)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    digest = hashlib.sha1('\0'.join(names).encode('utf-8', 'surrogateescape'))
+    digest.update(stamps.tobytes())
+    return digest.hexdigest()
+
+def thumb_sync_state():
+    images = source_stamp(IMAGE_FOLDER)
+    thumbs_path = THUMB_STORE.index_path if THUMB_STORE is not None else THUMB_FOLDER
+    try:
+        st = os.stat(thumbs_path)
+        thumbs = [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        thumbs = None
+    params = [thumb_fingerprint(), thumb_fingerprint(video=True), FFMPEG is not None, THUMB_STORE is not None]
+    return {"images": images, "thumbs": thumbs, "params": params}
+
+def load_sync_state(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_sync_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def plan_thumb_sync(manifest, meta):
+    sources = {}
+    media_bases = set()
+    extensions = poster_extensions()
+    fingerprints = {False: thumb_fingerprint(), True: thumb_fingerprint(video=True)}
+    with os.scandir(IMAGE_FOLDER) as it:
+        for e in it:
+            lower = e.name.lower()
+            if not lower.endswith(MEDIA_EXTENSIONS) or not e.is_file():
+                continue
+            base = e.name.rpartition('.')[0]
+            media_bases.add(base)
+            if lower.endswith(extensions):
+                st = e.stat()
+                fingerprint = fingerprints[lower.endswith(VIDEO_EXTENSIONS)]
+                sources[e.name] = (st.st_size, st.st_mtime_ns, base, fingerprint)
+    thumb_names = set(THUMB_STORE.scan()[1]) if THUMB_STORE is not None else set(os.listdir(THUMB_FOLDER))
+    
+    to_generate = []
+    to_describe = []
+    for name, (size, mtime, base, fingerprint) in sources.items():
+        thumb_name = base + '.jpg'
+        entry = manifest.get(name)
+        if entry is not None:
+            if entry[0] == size and entry[1] == mtime and entry[2] == fingerprint:
+                if not entry[3]:
+                    continue
+                if thumb_name in thumb_names:
+                    if name not in meta:
+                        to_describe.append(name)
+                    continue
+        elif thumb_name in thumb_names and THUMB_STORE is None:
+            try:
+                if os.stat(os.path.join(THUMB_FOLDER, thumb_name)).st_mtime_ns >= mtime:
+                    manifest[name] = [size, mtime, fingerprint, True]
+                    to_describe.append(name)
+                    continue
+            except OSError:
+                pass
+        to_generate.append(name)
+    
+    deleted = [name for name in manifest if name not in sources]
+    orphans = [t for t in thumb_names
+               if t.endswith(('.jpg', '.webp')) and t.rpartition('.')[0] not in media_bases]
+    return sources, to_generate, to_describe, deleted, orphans
+
+def generate_thumbs(workers=THUMB_WORKERS):
     os.makedirs(THUMB_FOLDER, exist_ok=True)
     
-    all_files = [f for f in os.listdir(IMAGE_FOLDER) 
-                 if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+    state = thumb_sync_state()
+    if state == load_sync_state(THUMB_SYNC_STATE):
+        THUMB_PROGRESS.update(total=0, done=0, failed=0, started=time.time())
+        return 0
     
-    to_generate = []
-    for fname in all_files:
-        base_name = os.path.splitext(fname)[0]
-        thumb_path = os.path.join(THUMB_FOLDER, f"{base_name}.jpg")
-        if not os.path.exists(thumb_path):
-            to_generate.append(fname)
+    manifest = load_manifest(THUMB_MANIFEST)
+    meta = load_manifest(THUMB_META)
+    manifest_size = len(manifest)
+    meta_size = len(meta)
+    migrated = False
+    for name, entry in manifest.items():
+        if len(entry) > 4:
+            if entry[4]:
+                meta[name] = dict(entry[4], size=entry[0])
+            del entry[4:]
+            migrated = True
+    sources, to_generate, to_describe, deleted, orphans = plan_thumb_sync(manifest, meta)
     
-    for fname in to_generate:
-        src_path = os.path.join(IMAGE_FOLDER, fname)
-        base_name = os.path.splitext(fname)[0]
-        thumb_path = os.path.join(THUMB_FOLDER, f"{base_name}.jpg")
-        
+    for name in deleted:
+        del manifest[name]
+    for name in [n for n in meta if n not in sources]:
+        del meta[name]
+    for thumb_name in orphans:
         try:
-            with Image.open(src_path) as img:
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGBA')
-                    background = Image.new('RGBA', img.size, (255, 255, 255, 255))
-                    background.paste(img, mask=img.split()[-1])
-                    img = background.convert('RGB')
-                else:
-                    img = img.convert('RGB')
-                
-                img.thumbnail(THUMB_SIZE, Image.Resampling.LANCZOS)
-                img.save(thumb_path, "JPEG", quality=THUMB_QUALITY, optimize=True)
-        except:
+            remove_thumb(os.path.join(THUMB_FOLDER, thumb_name))
+        except OSError:
             pass
+    
+    total = len(to_generate) + len(to_describe)
+    THUMB_PROGRESS.update(total=total, done=0, failed=0, started=time.time())
+    if not total:
+        if migrated or deleted or len(manifest) != manifest_size:
+            save_manifest(THUMB_MANIFEST, manifest)
+        if migrated or len(meta) != meta_size:
+            save_manifest(THUMB_META, meta)
+        state["thumbs"] = thumb_sync_state()["thumbs"]
+        save_sync_state(THUMB_SYNC_STATE, state)
+        return 0
+    
+    names = to_generate + to_describe
+    src_paths = [os.path.join(IMAGE_FOLDER, f) for f in names]
+    thumb_paths = [os.path.join(THUMB_FOLDER, f"{os.path.splitext(f)[0]}.jpg") for f in names]
+    started = time.time()
+    last_report = 0
+    last_save = started
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = chain(
+            executor.map(render_thumb, src_paths[:len(to_generate)], thumb_paths[:len(to_generate)], chunksize=16),
+            describe_thumbs(executor, src_paths[len(to_generate):], thumb_paths[len(to_generate):]))
+        for pos, (name, result) in enumerate(zip(names, results)):
+            if THUMB_STORE is not None and result is not None and pos < len(to_generate):
+                thumb_path = thumb_paths[pos]
+                THUMB_STORE.ingest(thumb_path)
+                THUMB_STORE.ingest(f"{os.path.splitext(thumb_path)[0]}.webp")
+            size, mtime, _, fingerprint = sources[name]
+            ok = result is not None or pos >= len(to_generate)
+            manifest[name] = [size, mtime, fingerprint, ok]
+            if ok:
+                meta[name] = dict(result or {}, size=size)
+            THUMB_PROGRESS['done'] += 1
+            if not ok:
+                THUMB_PROGRESS['failed'] += 1
+            now = time.time()
+            done = THUMB_PROGRESS['done']
+            if now - last_save >= MANIFEST_SAVE_INTERVAL:
+                last_save = now
+                save_manifest(THUMB_MANIFEST, manifest)
+                save_manifest(THUMB_META, meta)
+            if now - last_report >= THUMB_REPORT_INTERVAL or done == total:
+                last_report = now
+                rate = done / max(now - started, 1e-6)
+                eta = (total - done) / rate if rate else 0
+                print(f"🖼️ Превью: {done}/{total} ({rate:.1f}/с, осталось ~{eta:.0f} с)", flush=True)
+    
+    save_manifest(THUMB_MANIFEST, manifest)
+    save_manifest(THUMB_META, meta)
+    state["thumbs"] = thumb_sync_state()["thumbs"]
+    save_sync_state(THUMB_SYNC_STATE, state)
+    return total - THUMB_PROGRESS['failed']
+
+def backfill_thumbs():
+    generate_thumbs()
+    if THUMB_STORE is not None:
+        THUMB_STORE.maybe_compact()
+
+def start_thumb_backfill():
+    thread = threading.Thread(target=backfill_thumbs, daemon=True)
+    thread.start()
+    return thread
+
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+def load_hash_pixels(path):
+    try:
+        with open_thumb(path) as f, Image.open(f) as img:
+            img.draft('L', (HASH_IMAGE_SIZE * 2, HASH_IMAGE_SIZE * 2))
+            img = img.convert('L').resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.Resampling.BILINEAR)
+            return np.asarray(img, dtype=np.float32)
+    except Exception:
+        return None
+
+def phash_batch(pixels):
+    dct = dct_matrix(HASH_IMAGE_SIZE)
+    low = (dct @ pixels @ dct.T)[:, :8, :8].reshape(len(pixels), 64)
+    bits = low > np.median(low[:, 1:], axis=1)[:, None]
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+def hamming(a, b):
+    x = np.bitwise_xor(a, b)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    return np.unpackbits(np.atleast_1d(x).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+class SimilarityIndex:
+    def __init__(self, thumb_folder, hash_path):
+        self.thumb_folder = thumb_folder
+        self.hash_path = hash_path
+        self.lock = threading.Lock()
+        self.names = []
+        self.positions = {}
+        self.hashes = None
+        self.mtimes = None
+        self.tables = []
+        self.hidden = frozenset()
+        self.failed = {}
+        self.version = 0
+        self.loaded = False
+        self._folder_mtime = None
+        self._watcher = None
+
+    def _load_saved(self):
+        try:
+            with np.load(self.hash_path) as data:
+                return list(data['names']), data['hashes'], data['mtimes']
+        except (OSError, ValueError, KeyError):
+            return [], np.zeros(0, np.uint64), np.zeros(0, np.int64)
+
+    def _save(self, names, hashes, mtimes):
+        tmp_path = f"{self.hash_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=str), hashes=hashes, mtimes=mtimes)
+        os.replace(tmp_path, self.hash_path)
+
+    def _compute(self, paths, workers=THUMB_WORKERS):
+        hashes = np.zeros(len(paths), np.uint64)
+        ok = np.zeros(len(paths), bool)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(paths), HASH_BATCH):
+                batch = list(executor.map(load_hash_pixels, paths[start:start + HASH_BATCH]))
+                loaded = [i for i, pixels in enumerate(batch) if pixels is not None]
+                if loaded:
+                    hashes[start + np.array(loaded)] = phash_batch(np.stack([batch[i] for i in loaded]))
+                    ok[start + np.array(loaded)] = True
+        return hashes, ok
+
+    def _chunks(self, hashes, chunk):
+        bits = 64 // HASH_CHUNKS
+        return ((hashes >> np.uint64(chunk * bits)) & np.uint64((1 << bits) - 1)).astype(np.int64)
+
+    def _build_tables(self, hashes):
+        tables = []
+        for chunk in range(HASH_CHUNKS):
+            values = self._chunks(hashes, chunk)
+            order = np.argsort(values, kind='stable')
+            tables.append((values[order], order))
+        return tables
+
+    def _near_duplicates(self, names, hashes, tables):
+        hidden = set()
+        for values, order in tables:
+            offset = 1
+            while offset < len(values):
+                same = np.nonzero(values[offset:] == values[:-offset])[0]
+                if not len(same):
+                    break
+                first, second = order[same], order[same + offset]
+                close = hamming(hashes[first], hashes[second]) <= DUPLICATE_RADIUS
+                hidden.update(names[i] for i in np.maximum(first, second)[close])
+                offset += 1
+        return frozenset(hidden)
+
+    def refresh(self):
+        folder_mtime = thumb_version(self.thumb_folder)
+        if self.loaded and folder_mtime == self._folder_mtime:
+            return False
+
+        if self.loaded:
+            names, hashes, mtimes = self.names, self.hashes, self.mtimes
+        else:
+            names, hashes, mtimes = self._load_saved()
+        known = {name: i for i, name in enumerate(names)}
+
+        current = {}
+        if THUMB_STORE is not None:
+            current = {name[:-4]: mtime for name, mtime in THUMB_STORE.scan('.jpg')[1].items()}
+        elif folder_mtime is not None:
+            with os.scandir(self.thumb_folder) as it:
+                for entry in it:
+                    if entry.name.endswith('.jpg') and entry.is_file():
+                        current[entry.name[:-4]] = entry.stat().st_mtime_ns
+
+        keep = [name for name, mtime in current.items() if name in known and mtimes[known[name]] == mtime]
+        todo = [name for name in current
+                if (name not in known or mtimes[known[name]] != current[name]) and self.failed.get(name) != current[name]]
+        keep_idx = np.array([known[name] for name in keep], dtype=np.int64)
+        new_hashes, ok = self._compute([os.path.join(self.thumb_folder, f"{name}.jpg") for name in todo])
+        done = [name for name, good in zip(todo, ok) if good]
+        self.failed.update((name, current[name]) for name, good in zip(todo, ok) if not good)
+
+        all_names = keep + done
+        all_hashes = np.concatenate([hashes[keep_idx], new_hashes[ok]])
+        all_mtimes = np.array([current[name] for name in all_names], dtype=np.int64)
+        order = sorted(range(len(all_names)), key=lambda i: sort_key(all_names[i]))
+        all_names = [all_names[i] for i in order]
+        all_hashes = all_hashes[np.array(order, dtype=np.int64)]
+        all_mtimes = all_mtimes[np.array(order, dtype=np.int64)]
+
+        tables = self._build_tables(all_hashes)
+        hidden = self._near_duplicates(all_names, all_hashes, tables)
+        if todo or len(all_names) != len(names) or not self.loaded and not os.path.exists(self.hash_path):
+            self._save(all_names, all_hashes, all_mtimes)
+        if todo:
+            print(f"🧬 Хэши: {len(done)} новых, всего {len(all_names)}, похожих скрыто {len(hidden)}", flush=True)
+
+        with self.lock:
+            self.names = all_names
+            self.positions = {name: i for i, name in enumerate(all_names)}
+            self.hashes = all_hashes
+            self.mtimes = all_mtimes
+            self.tables = tables
+            self.hidden = hidden
+            self._folder_mtime = folder_mtime
+            self.version += 1
+            self.loaded = True
+        return True
+
+    def similar(self, name, radius=SIMILAR_RADIUS, limit=SIMILAR_LIMIT):
+        with self.lock:
+            i = self.positions.get(name)
+            if i is None:
+                return None
+            names, hashes, tables = self.names, self.hashes, self.tables
+        target = hashes[i:i + 1]
+        bits = 64 // HASH_CHUNKS
+        flips = [0] + [sum(1 << b for b in combo)
+                       for count in range(1, radius // HASH_CHUNKS + 1)
+                       for combo in combinations(range(bits), count)]
+        flips = np.array(flips, dtype=np.int64)
+        
+        candidates = []
+        for chunk, (values, order) in enumerate(tables):
+            probes = self._chunks(target, chunk)[0] ^ flips
+            lo = np.searchsorted(values, probes, 'left')
+            hi = np.searchsorted(values, probes, 'right')
+            candidates.extend(order[a:b] for a, b in zip(lo, hi) if b > a)
+        if not candidates:
+            return []
+        candidates = np.unique(np.concatenate(candidates))
+        candidates = candidates[candidates != i]
+        distances = hamming(hashes[candidates], target[0])
+        close = distances <= radius
+        candidates, distances = candidates[close], distances[close]
+        ranked = np.lexsort((candidates, distances))[:limit]
+        return [(names[candidates[k]], int(distances[k])) for k in ranked]
+
+    def _watch(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            time.sleep(interval)
+
+    def start_watcher(self, interval=HASH_POLL_INTERVAL):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self._watcher.start()
+
+SIMILARITY = SimilarityIndex(THUMB_FOLDER, HASH_FILE)
+
+def route_label(path):
+    path = path.split('?', 1)[0]
+    if path.startswith('/api/'):
+        route = '/' + '/'.join(path.split('/')[1:3])
+        return route if route in METRIC_ROUTES else '/api/other'
+    if path.startswith('/thumb/'):
+        return '/thumb'
+    for folder in (IMAGE_FOLDER, THUMB_FOLDER):
+        if path.startswith(f'/{folder}/'):
+            return f'/{folder}'
+    return '/'
+
+METRIC_ROUTES = ('/api/images', '/api/stats', '/api/search', '/api/tags', '/api/similar',
+                 '/api/thumbs', '/api/metrics', '/api/profile')
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS, window=LATENCY_WINDOW):
+        self.buckets = buckets
+        self.window = window
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.histograms = {}
+        self.samples = {}
+        self.bytes_sent = {}
+        self.in_flight = 0
+        self.connections = 0
+        self.started = time.time()
+
+    def connection(self, delta):
+        with self.lock:
+            self.connections += delta
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, route, status, seconds, nbytes):
+        with self.lock:
+            self.in_flight -= 1
+            key = (route, status or 0)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + nbytes
+            hist = self.histograms.get(route)
+            if hist is None:
+                hist = self.histograms[route] = [[0] * len(self.buckets), 0.0, 0]
+                self.samples[route] = deque(maxlen=self.window)
+            pos = bisect.bisect_left(self.buckets, seconds)
+            if pos < len(self.buckets):
+                hist[0][pos] += 1
+            hist[1] += seconds
+            hist[2] += 1
+            self.samples[route].append(seconds)
+
+    def render(self):
+        lines = []
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.lock:
+            requests_total = sorted(self.requests.items())
+            bytes_sent = sorted(self.bytes_sent.items())
+            histograms = {route: (list(h[0]), h[1], h[2]) for route, h in self.histograms.items()}
+            samples = {route: sorted(s) for route, s in self.samples.items()}
+            in_flight = self.in_flight
+            connections = self.connections
+
+        metric("gallery_requests_total", "counter", "Requests served by route and status.",
+               [((("route", r), ("status", st)), n) for (r, st), n in requests_total])
+        metric("gallery_response_bytes_total", "counter", "Response body bytes by route.",
+               [((("route", r),), n) for r, n in bytes_sent])
+        
+        lines.append("# HELP gallery_request_duration_seconds Request handling time.")
+        lines.append("# TYPE gallery_request_duration_seconds histogram")
+        for route in sorted(histograms):
+            counts, total, count = histograms[route]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'gallery_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(f'gallery_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'gallery_request_duration_seconds_sum{{route="{route}"}} {total:.6f}')
+            lines.append(f'gallery_request_duration_seconds_count{{route="{route}"}} {count}')
+        
+        lines.append(f"# HELP gallery_request_latency_seconds Latency quantiles over the last {self.window} "
+                     "requests per route.")
+        lines.append("# TYPE gallery_request_latency_seconds summary")
+        for route in sorted(samples):
+            values = samples[route]
+            for q in LATENCY_QUANTILES:
+                value = values[min(int(q * len(values)), len(values) - 1)]
+                lines.append(f'gallery_request_latency_seconds{{route="{route}",quantile="{q}"}} {value:.6f}')
+            _, total, count = histograms[route]
+            lines.append(f'gallery_request_latency_seconds_sum{{route="{route}"}} {total:.6f}')
+            lines.append(f'gallery_request_latency_seconds_count{{route="{route}"}} {count}')
+
+        metric("gallery_in_flight_requests", "gauge", "Requests being handled right now.", [((), in_flight)])
+        metric("gallery_open_connections", "gauge", "Open client connections.",
+               [((), connections + ASYNC_CONNECTIONS)])
+        
+        metric("gallery_thumb_cache_requests_total", "counter", "On-demand thumbnail cache lookups.",
+               [((("result", "hit"),), THUMB_CACHE.hits), ((("result", "miss"),), THUMB_CACHE.misses),
+                ((("result", "coalesced"),), THUMB_CACHE.coalesced)])
+        metric("gallery_thumb_cache_bytes", "gauge", "Bytes held by the on-demand thumbnail cache.",
+               [((), THUMB_CACHE.total_bytes)])
+        metric("gallery_thumb_pack_requests_total", "counter", "Thumbnail pack lookups.",
+               [((("result", "hit"),), THUMB_PACKS.hits), ((("result", "miss"),), THUMB_PACKS.misses),
+                ((("result", "coalesced"),), THUMB_PACKS.coalesced)])
+        metric("gallery_thumb_pack_bytes", "gauge", "Bytes held by pre-built thumbnail packs.",
+               [((), THUMB_PACKS.total_bytes)])
+        if THUMB_STORE is not None:
+            metric("gallery_thumb_store_bytes", "gauge", "Bytes in the packed thumbnail store segments.",
+                   [((("state", "live"),), THUMB_STORE.live_bytes), ((("state", "dead"),), THUMB_STORE.dead_bytes)])
+            metric("gallery_thumb_store_entries", "gauge", "Thumbnails held by the packed store.",
+                   [((), len(THUMB_STORE.entries))])
+        metric("gallery_response_cache_requests_total", "counter", "Rendered response cache lookups.",
+               [((("result", "hit"),), RESPONSE_CACHE.hits), ((("result", "miss"),), RESPONSE_CACHE.misses)])
+        
+        backlog = max(THUMB_PROGRESS['total'] - THUMB_PROGRESS['done'], 0)
+        metric("gallery_thumb_backlog", "gauge", "Thumbnails still queued for the backfill.", [((), backlog)])
+        metric("gallery_thumbs_generated_total", "counter", "Thumbnails rendered by the backfill.",
+               [((), THUMB_PROGRESS['done'] - THUMB_PROGRESS['failed'])])
+        metric("gallery_thumbs_failed_total", "counter", "Thumbnails the backfill failed to render.",
+               [((), THUMB_PROGRESS['failed'])])
+        
+        images, thumbs = CATALOG.counts()
+        metric("gallery_catalog_images", "gauge", "Media files in the catalog.", [((), images)])
+        metric("gallery_catalog_thumbs", "gauge", "Thumbnails in the catalog.", [((), thumbs)])
+        metric("gallery_tag_index_tags", "gauge", "Distinct tags in the search index.", [((), len(TAG_INDEX.names))])
+        metric("gallery_similarity_hashes", "gauge", "Thumbnails with a perceptual hash.",
+               [((), len(SIMILARITY.names))])
+        metric("gallery_profiler_running", "gauge", "1 while the sampling profiler is collecting.",
+               [((), int(PROFILER.running))])
+        metric("gallery_uptime_seconds", "gauge", "Seconds since the server started.",
+               [((), f"{time.time() - self.started:.0f}")])
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        with self.lock:
+            items = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return ''.join(f"{stack} {count}\n" for stack, count in items)
+
+PROFILER = SamplingProfiler()
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
 
 class CustomHandler(http.server.SimpleHTTPRequestHandler):
+    head_only = False
+    body_wfile = None
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.send_header('Access-Control-Max-Age', '86400')
         super().end_headers()
+        if self.head_only and self.body_wfile is None:
+            self.body_wfile = self.wfile
+            self.wfile = NullWriter()
     
+    def setup(self):
+        super().setup()
+        METRICS.connection(1)
+
+    def finish(self):
+        METRICS.connection(-1)
+        super().finish()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.response_bytes = getattr(self, 'response_bytes', 0) + int(value)
+        super().send_header(keyword, value)
+
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
+    def do_HEAD(self):
+        self.head_only = True
+        try:
+            self.do_GET()
+        finally:
+            if self.body_wfile is not None:
+                self.wfile = self.body_wfile
+                self.body_wfile = None
+            self.head_only = False
+
     def do_GET(self):
+        route = route_label(self.path)
+        self.response_status = None
+        self.response_bytes = 0
+        started = time.perf_counter()
+        METRICS.begin()
+        try:
+            self.route_get()
+        finally:
+            METRICS.end(route, self.response_status, time.perf_counter() - started, self.response_bytes)
+
+    def route_get(self):
         if self.path.startswith('/api/images'):
             self.handle_api_images()
         elif self.path == '/api/stats':
             self.handle_api_stats()
+        elif self.path == '/api/metrics':
+            self.handle_api_metrics()
+        elif self.path.startswith('/api/profile'):
+            self.handle_api_profile()
+        elif self.path.startswith('/api/search'):
+            self.handle_api_search()
+        elif self.path.startswith('/api/tags'):
+            self.handle_api_tags()
+        elif self.path.startswith('/api/similar/'):
+            self.handle_api_similar()
+        elif self.path.startswith('/api/thumbs/pack'):
+            self.handle_api_thumb_pack()
+        elif self.path.startswith('/thumb/'):
+            self.handle_thumb()
         elif self.path.startswith(f'/{IMAGE_FOLDER}/') or self.path.startswith(f'/{THUMB_FOLDER}/'):
             self.handle_static_files()
         else:
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.end_headers()
-            html_content = self.get_html_content()
-            self.wfile.write(html_content.encode('utf-8'))
-    
+            host = self.headers.get('Host', f'localhost:{PORT}')
+            self.send_cached(('html', host), lambda: self.get_html_content().encode('utf-8'),
+                             'text/html; charset=utf-8', 'no-cache')
+
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or f'W/{etag}' in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_not_modified(self, etag, last_modified, cache_control=None):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(last_modified))
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
+    def send_cached(self, key, build, content_type, cache_control=None):
+        CATALOG.ensure_loaded()
+        version = CATALOG.version
+        last_modified = CATALOG.last_modified
+        entry = RESPONSE_CACHE.get(key, version,
+                                   lambda: CachedResponse(build(), content_type, last_modified))
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding'), len(entry.bodies[None]))
+        body, etag = entry.get(encoding)
+        if self.is_not_modified(etag, entry.last_modified):
+            self.send_not_modified(etag, entry.last_modified, cache_control)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', entry.content_type)
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(entry.last_modified))
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def get_html_content(self):
-        images_count = len([f for f in os.listdir(IMAGE_FOLDER) 
-                           if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.webm', '.mp4'))]) if os.path.exists(IMAGE_FOLDER) else 0
-        thumbs_count = len(os.listdir(THUMB_FOLDER)) if os.path.exists(THUMB_FOLDER) else 0
+        images_count, thumbs_count = CATALOG.counts()
         host = self.headers.get('Host', f'localhost:{PORT}')
         
         return f"""
@@ -221,6 +2392,41 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
                         <code>GET <a href="/api/images">http://{host}/api/images</a></code>
                     </div>
                     
+                    <div class="endpoint">
+                        <h3>🏷️ Поиск по тегам</h3>
+                        <code>GET http://{host}/api/search?tags=тег1+тег2+-тег3&amp;page=1</code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>💡 Автодополнение тегов</h3>
+                        <code>GET http://{host}/api/tags?prefix=kita</code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>👯 Похожие изображения</h3>
+                        <code>GET http://{host}/api/similar/[имя_файла]?distance=8</code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>📦 Пачка превью для страницы</h3>
+                        <code>GET <a href="/api/thumbs/pack?cursor=0">http://{host}/api/thumbs/pack?cursor=0</a></code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>🧹 Без почти-дубликатов</h3>
+                        <code>GET <a href="/api/images?unique=1">http://{host}/api/images?unique=1</a></code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>📈 Метрики (Prometheus)</h3>
+                        <code>GET <a href="/api/metrics">http://{host}/api/metrics</a></code>
+                    </div>
+                    
+                    <div class="endpoint">
+                        <h3>🔥 Профилировщик (--profile)</h3>
+                        <code>GET http://{host}/api/profile?action=start|stop|reset</code>
+                    </div>
+                    
                     <div class="endpoint">
                         <h3>📊 Статистика</h3>
                         <code>GET <a href="/api/stats">http://{host}/api/stats</a></code>
@@ -235,6 +2441,11 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
                         <h3>🔍 Превьюшка (320x426)</h3>
                         <code>GET http://{host}/{THUMB_FOLDER}/[имя_файла].jpg</code>
                     </div>
+                    
+                    <div class="endpoint">
+                        <h3>🧩 Превьюшка любого размера</h3>
+                        <code>GET http://{host}/thumb/[ширина]x[высота]/[имя_файла]?fmt=webp|avif|jpeg</code>
+                    </div>
                 </div>
                 
                 <div style="text-align: center;">
@@ -253,85 +2464,344 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
         """
     
     def handle_api_images(self):
-        self.send_response(200)
-        self.send_header("Content-type", "application/json; charset=utf-8")
-        self.send_header("Cache-Control", "public, max-age=300")
-        self.end_headers()
-
         query = self.path.split('?')[1] if '?' in self.path else ''
         params = dict(q.split('=') for q in query.split('&')) if query else {}
         page = int(params.get('page', 1))
-        per_page = PAGE_SIZE
 
-        files = []
-        image_path = os.path.join(os.getcwd(), IMAGE_FOLDER)
-        
-        if os.path.isdir(image_path):
-            all_files = sorted(os.listdir(image_path))
-            start = (page - 1) * per_page
-            end = start + per_page
-            paginated_files = all_files[start:end]
-            
-            for fname in paginated_files:
-                lower = fname.lower()
-                if not lower.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.webm', '.mp4')):
-                    continue
-                    
-                base = os.path.splitext(fname)[0]
-                thumb_fname = f"{base}.jpg"
-                thumb_exists = os.path.exists(os.path.join(THUMB_FOLDER, thumb_fname))
-                is_video = lower.endswith(('.webm', '.mp4', '.gif'))
-                
-                files.append({
-                    "name": fname,
-                    "url": f"/{IMAGE_FOLDER}/{fname}",
-                    "thumb": f"/{THUMB_FOLDER}/{thumb_fname}" if thumb_exists and not is_video else None,
-                    "isVideo": is_video
-                })
-        
-        self.wfile.write(json.dumps(files, ensure_ascii=False).encode('utf-8'))
+        if params.get('unique') in ('1', 'true') and SIMILARITY.loaded:
+            self.send_cached(('images', page, 'unique', SIMILARITY.version),
+                             lambda: json.dumps(self.unique_page(page), ensure_ascii=False).encode('utf-8'),
+                             "application/json; charset=utf-8", "public, max-age=300")
+            return
+        self.send_cached(('images', page),
+                         lambda: json.dumps(CATALOG.page(page, PAGE_SIZE), ensure_ascii=False).encode('utf-8'),
+                         "application/json; charset=utf-8", "public, max-age=300")
+
+    def unique_page(self, page):
+        def build():
+            hidden = CATALOG.positions_for(SIMILARITY.hidden)
+            return hidden, [pos - i for i, pos in enumerate(hidden)]
+
+        hidden, visible_before = SEARCH_CACHE.get(('unique',), (CATALOG.version, SIMILARITY.version), build)
+        start = max(page - 1, 0) * PAGE_SIZE
+        first = start + bisect.bisect_right(visible_before, start)
+        last = start + PAGE_SIZE - 1 + bisect.bisect_right(visible_before, start + PAGE_SIZE - 1)
+        skip = set(hidden[bisect.bisect_left(hidden, first):bisect.bisect_right(hidden, last)])
+        return [e for pos, e in enumerate(CATALOG.slice(first, last - first + 1), first) if pos not in skip]
+
+    def handle_api_thumb_pack(self):
+        params = parse_qs(urlsplit(self.path).query)
+        try:
+            cursor = int(params.get('cursor', ['0'])[0])
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            self.send_error(400, "Bad cursor")
+            return
+        total, _ = CATALOG.counts()
+        if cursor % PAGE_SIZE or (cursor and cursor >= total):
+            self.send_error(404, "No thumbnail pack at this cursor")
+            return
+        path = THUMB_PACKS.get(cursor)
+        if path is None:
+            self.send_error(503, "Thumbnail pack unavailable")
+            return
+        THUMB_PACKS.prefetch(cursor + PAGE_SIZE)
+        self.send_file(path, 'public, max-age=300')
+
+    def handle_api_similar(self):
+        if np is None:
+            self.send_error(503, "numpy is required for similarity search")
+            return
+        url = urlsplit(self.path)
+        name = os.path.splitext(unquote(url.path[len('/api/similar/'):]))[0]
+        params = parse_qs(url.query)
+        try:
+            radius = min(max(int(params.get('distance', [str(SIMILAR_RADIUS)])[0]), 0), SIMILAR_MAX_RADIUS)
+        except ValueError:
+            radius = SIMILAR_RADIUS
+
+        matches = SIMILARITY.similar(name, radius)
+        if matches is None:
+            self.send_error(404, "No perceptual hash for this file yet")
+            return
+        self.send_cached(('similar', SIMILARITY.version, name, radius),
+                         lambda: self.get_similar_body(name, radius, matches),
+                         "application/json; charset=utf-8", "public, max-age=300")
+
+    def get_similar_body(self, name, radius, matches):
+        distances = dict(matches)
+        items = [dict(entry, distance=distances[os.path.splitext(entry["name"])[0]])
+                 for entry in CATALOG.entries_for([match for match, _ in matches])]
+        items.sort(key=lambda e: e["distance"])
+        return json.dumps({"name": name, "distance": radius, "items": items}, ensure_ascii=False).encode('utf-8')
     
-    def handle_api_stats(self):
-        self.send_response(200)
-        self.send_header("Content-type", "application/json; charset=utf-8")
+    def handle_api_search(self):
+        params = parse_qs(urlsplit(self.path).query)
+        terms = params.get('tags', [''])[0].lower().split()
+        include = tuple(sorted({t for t in terms if not t.startswith('-')}))
+        exclude = tuple(sorted({t[1:] for t in terms if t.startswith('-') and len(t) > 1}))
+        try:
+            page = max(int(params.get('page', ['1'])[0]), 1)
+        except ValueError:
+            page = 1
+
+        TAG_INDEX.ensure_loaded()
+        self.send_cached(('search', TAG_INDEX.version, include, exclude, page),
+                         lambda: self.get_search_body(include, exclude, page),
+                         "application/json; charset=utf-8", "public, max-age=60")
+
+    def get_search_body(self, include, exclude, page):
+        def build():
+            present = CATALOG.present_ids()
+            return [post_id for post_id in TAG_INDEX.search(include, exclude) if post_id in present]
+
+        ids = SEARCH_CACHE.get((include, exclude), (CATALOG.version, TAG_INDEX.version), build)
+        start = (page - 1) * PAGE_SIZE
+        result = {
+            "include": include,
+            "exclude": exclude,
+            "total": len(ids),
+            "page": page,
+            "pageSize": PAGE_SIZE,
+            "items": CATALOG.entries_for([str(post_id) for post_id in ids[start:start + PAGE_SIZE]])
+        }
+        return json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+    def handle_api_tags(self):
+        params = parse_qs(urlsplit(self.path).query)
+        prefix = params.get('prefix', [''])[0].lower().strip()
+        try:
+            limit = min(max(int(params.get('limit', [str(TAG_SUGGEST_LIMIT)])[0]), 1), 100)
+        except ValueError:
+            limit = TAG_SUGGEST_LIMIT
+
+        TAG_INDEX.ensure_loaded()
+        self.send_cached(('tags', TAG_INDEX.version, prefix, limit),
+                         lambda: json.dumps(TAG_INDEX.suggest(prefix, limit), ensure_ascii=False).encode('utf-8'),
+                         "application/json; charset=utf-8", "public, max-age=300")
+
+    def send_text(self, code, text, content_type="text/plain; version=0.0.4; charset=utf-8"):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        
+        self.wfile.write(body)
+
+    def handle_api_metrics(self):
+        self.send_text(200, METRICS.render())
+
+    def handle_api_profile(self):
+        if not PROFILER_ENABLED:
+            self.send_error(403, "Profiler is disabled; start the server with --profile")
+            return
+        action = parse_qs(urlsplit(self.path).query).get('action', [''])[0]
+        if action == 'start':
+            PROFILER.start()
+        elif action == 'stop':
+            PROFILER.stop()
+        elif action == 'reset':
+            PROFILER.reset()
+        if action:
+            self.send_text(200, f"running={int(PROFILER.running)} samples={PROFILER.samples}\n")
+        else:
+            self.send_text(200, PROFILER.collapsed())
+
+    def handle_api_stats(self):
+        self.send_cached(('stats',), self.get_stats_body,
+                         "application/json; charset=utf-8", "no-cache")
+
+    def get_stats_body(self):
+        images_count, thumbs_count = CATALOG.counts()
         stats = {
-            "images": len([f for f in os.listdir(IMAGE_FOLDER) 
-                          if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.webm', '.mp4'))]),
-            "thumbs": len(os.listdir(THUMB_FOLDER)) if os.path.exists(THUMB_FOLDER) else 0,
+            "images": images_count,
+            "thumbs": thumbs_count,
             "port": PORT,
             "thumbSize": THUMB_SIZE,
             "thumbQuality": THUMB_QUALITY
         }
-        
-        self.wfile.write(json.dumps(stats, ensure_ascii=False).encode('utf-8'))
+        return json.dumps(stats, ensure_ascii=False).encode('utf-8')
     
+    def resolve_static_path(self):
+        filepath = os.path.normpath(unquote(urlsplit(self.path).path).lstrip('/'))
+        for folder in (IMAGE_FOLDER, THUMB_FOLDER):
+            if filepath.startswith(folder + os.sep):
+                return filepath
+        return None
+
+    def send_file_range(self, f, offset, count):
+        if self.head_only:
+            return
+        if hasattr(self.connection, 'sendfile'):
+            self.connection.sendfile(f, offset, count)
+            return
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, count))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
+
     def handle_static_files(self):
+        filepath = self.resolve_static_path()
+        if filepath and filepath.startswith(THUMB_FOLDER):
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'public, max-age=86400'
+        if THUMB_STORE is not None and filepath and os.path.dirname(filepath) == THUMB_FOLDER:
+            self.send_stored_thumb(os.path.basename(filepath), cache_control)
+            return
+        self.send_file(filepath, cache_control)
+
+    def if_range_matches(self, etag, mtime):
+        if_range = self.headers.get('If-Range')
+        if not if_range or if_range.strip() == etag:
+            return True
         try:
-            filepath = self.path.lstrip('/')
-            if not os.path.exists(filepath):
-                self.send_error(404, f"File not found: {filepath}")
-                return
-            
-            mime_type = self.get_mime_type(filepath)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', mime_type)
-            
-            if filepath.startswith(THUMB_FOLDER):
-                self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
-            else:
-                self.send_header('Cache-Control', 'public, max-age=86400')
-            
-            with open(filepath, 'rb') as f:
-                content = f.read()
-                self.send_header('Content-Length', str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
+            return int(mtime) <= parsedate_to_datetime(if_range).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def send_stored_thumb(self, name, cache_control):
+        found = THUMB_STORE.view(name)
+        if found is None:
+            self.send_error(404, f"File not found: {self.path}")
+            return
+        view, mtime_ns = found
+        size = len(view)
+        mtime = mtime_ns / 1e9
+        etag = f'"{size:x}-{mtime_ns:x}"'
+        if self.is_not_modified(etag, mtime):
+            self.send_not_modified(etag, mtime, cache_control)
+            return
+
+        ranges = parse_range(self.headers.get('Range'), size)
+        if ranges is not None and not self.if_range_matches(etag, mtime):
+            ranges = None
+        if ranges == []:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = ranges[0] if ranges and len(ranges) == 1 else (0, size - 1)
+        self.send_response(206 if ranges and len(ranges) == 1 else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('Content-Type', self.get_mime_type(name))
+        if ranges and len(ranges) == 1:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        try:
+            self.wfile.write(view[start:end + 1])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def handle_thumb(self):
+        url = urlsplit(self.path)
+        parts = unquote(url.path).split('/')
+        params = dict(q.split('=', 1) for q in url.query.split('&') if '=' in q)
+        try:
+            width, height = (int(v) for v in parts[2].split('x'))
+            name = parts[3]
+        except (IndexError, ValueError):
+            self.send_error(400, "Expected /thumb/{w}x{h}/{name}")
+            return
+        if (len(parts) != 4 or os.path.basename(name) != name or not name.lower().endswith(IMAGE_EXTENSIONS)
+                or not THUMB_MIN_DIM <= width <= THUMB_MAX_DIM or not THUMB_MIN_DIM <= height <= THUMB_MAX_DIM):
+            self.send_error(400, "Bad thumbnail request")
+            return
+        
+        requested = params.get('fmt', '').lower().replace('jpg', 'jpeg')
+        fmt = negotiate_thumb_format(requested, self.headers.get('Accept'))
+        if fmt is None:
+            self.send_error(400, f"Unsupported format: {requested}")
+            return
+        
+        src_path = os.path.join(IMAGE_FOLDER, name)
+        try:
+            path = THUMB_CACHE.get(src_path, width, height, fmt)
+        except OSError:
+            path = None
+        if path is None:
+            self.send_error(404, f"File not found: {name}")
+            return
+        self.send_file(path, 'public, max-age=86400', vary=None if requested else 'Accept')
+
+    def send_file(self, filepath, cache_control, vary=None):
+        try:
+            f = open(filepath, 'rb') if filepath else None
+        except OSError:
+            f = None
+        if f is None:
+            self.send_error(404, f"File not found: {self.path}")
+            return
+        
+        try:
+            with f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                etag = f'"{size:x}-{st.st_mtime_ns:x}"'
+                
+                if self.is_not_modified(etag, st.st_mtime):
+                    self.send_not_modified(etag, st.st_mtime, cache_control)
+                    return
                 
-        except Exception as e:
-            self.send_error(500, f"Internal server error: {str(e)}")
+                mime_type = self.get_mime_type(filepath)
+                ranges = parse_range(self.headers.get('Range'), size)
+                if ranges is not None and not self.if_range_matches(etag, st.st_mtime):
+                    ranges = None
+                
+                if ranges == []:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                
+                self.send_response(206 if ranges else 200)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Cache-Control', cache_control)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+                if vary:
+                    self.send_header('Vary', vary)
+                
+                if not ranges:
+                    self.send_header('Content-Type', mime_type)
+                    self.send_header('Content-Length', str(size))
+                    self.end_headers()
+                    self.send_file_range(f, 0, size)
+                elif len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.send_header('Content-Type', mime_type)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                    self.send_header('Content-Length', str(end - start + 1))
+                    self.end_headers()
+                    self.send_file_range(f, start, end - start + 1)
+                else:
+                    boundary = os.urandom(12).hex()
+                    parts = [(f"--{boundary}\r\nContent-Type: {mime_type}\r\n"
+                              f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode('ascii')
+                             for start, end in ranges]
+                    closing = f"--{boundary}--\r\n".encode('ascii')
+                    length = sum(len(p) + end - start + 3 for p, (start, end) in zip(parts, ranges)) + len(closing)
+                    self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+                    self.send_header('Content-Length', str(length))
+                    self.end_headers()
+                    for part, (start, end) in zip(parts, ranges):
+                        self.wfile.write(part)
+                        self.send_file_range(f, start, end - start + 1)
+                        self.wfile.write(b"\r\n")
+                    self.wfile.write(closing)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
     
     def get_mime_type(self, filename):
         ext = os.path.splitext(filename)[1].lower()
@@ -341,8 +2811,10 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
             '.png': 'image/png',
             '.gif': 'image/gif',
             '.webp': 'image/webp',
+            '.avif': 'image/avif',
             '.mp4': 'video/mp4',
-            '.webm': 'video/webm'
+            '.webm': 'video/webm',
+            '.pack': 'application/vnd.gallery.thumb-pack'
         }
         return mime_types.get(ext, 'application/octet-stream')
 
@@ -351,6 +2823,116 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     request_queue_size = 100
 
+class BufferedWriter:
+    def __init__(self, ops):
+        self.ops = ops
+
+    def write(self, data):
+        self.ops.append(('data', bytes(data)))
+        return len(data)
+
+    def flush(self):
+        pass
+
+class AsyncRequestHandler(CustomHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, raw_request, client_address):
+        self.client_address = client_address
+        self.server = None
+        self.request = self.connection = None
+        self.close_connection = True
+        requestline, _, rest = raw_request.partition(b'\r\n')
+        self.raw_requestline = requestline + b'\r\n'
+        self.rfile = io.BytesIO(rest)
+        self.ops = []
+        self.wfile = BufferedWriter(self.ops)
+
+    def end_headers(self):
+        if self.request_version == 'HTTP/1.0' and not self.close_connection:
+            self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+
+    def send_file_range(self, f, offset, count):
+        if self.head_only:
+            return
+        self.ops.append(('file', os.fdopen(os.dup(f.fileno()), 'rb'), offset, count))
+
+    def run(self):
+        if not self.parse_request():
+            return self
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(501, f"Unsupported method ({self.command!r})")
+        else:
+            try:
+                method()
+            except Exception as e:
+                if not self.ops:
+                    self.send_error(500, f"Internal server error: {str(e)}")
+                self.close_connection = True
+        return self
+
+ASYNC_HANDLER_POOL = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_WORKERS)
+ASYNC_CONNECTIONS = 0
+
+async def write_ops(writer, ops):
+    loop = asyncio.get_running_loop()
+    try:
+        for op in ops:
+            if op[0] == 'data':
+                writer.write(op[1])
+                await asyncio.wait_for(writer.drain(), ASYNC_SEND_TIMEOUT)
+            else:
+                await asyncio.wait_for(writer.drain(), ASYNC_SEND_TIMEOUT)
+                await loop.sendfile(writer.transport, op[1], op[2], op[3])
+    finally:
+        for op in ops:
+            if op[0] == 'file':
+                op[1].close()
+
+async def handle_async_connection(reader, writer):
+    global ASYNC_CONNECTIONS
+    loop = asyncio.get_running_loop()
+    peer = writer.get_extra_info('peername') or ('', 0)
+    ASYNC_CONNECTIONS += 1
+    try:
+        if ASYNC_CONNECTIONS > ASYNC_MAX_CONNECTIONS:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return
+        writer.transport.set_write_buffer_limits(high=ASYNC_WRITE_BUFFER_HIGH)
+        while True:
+            try:
+                raw = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), ASYNC_KEEPALIVE_TIMEOUT)
+            except asyncio.LimitOverrunError:
+                writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            handler = await loop.run_in_executor(ASYNC_HANDLER_POOL, AsyncRequestHandler(raw, peer[:2]).run)
+            content_length = handler.headers.get('Content-Length') if getattr(handler, 'headers', None) else None
+            if content_length:
+                try:
+                    await reader.readexactly(int(content_length))
+                except ValueError:
+                    handler.close_connection = True
+            if getattr(handler, 'headers', None) and handler.headers.get('Transfer-Encoding'):
+                handler.close_connection = True
+            await write_ops(writer, handler.ops)
+            if handler.close_connection:
+                return
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        ASYNC_CONNECTIONS -= 1
+        writer.close()
+
+async def serve_async(host, port):
+    server = await asyncio.start_server(handle_async_connection, host, port,
+                                        limit=ASYNC_MAX_HEADER_BYTES, backlog=1024, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
 def get_local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -362,26 +2944,52 @@ def get_local_ip():
         return "127.0.0.1"
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default=SERVER_ENGINE)
+    parser.add_argument('--catalog', default=None)
+    parser.add_argument('--tags-db', default=TAGS_DB)
+    parser.add_argument('--profile', action='store_true', default=PROFILER_ENABLED)
+    parser.add_argument('--thumb-store', action='store_true')
+    args = parser.parse_args()
+    
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     
+    PROFILER_ENABLED = args.profile
+    
+    if args.catalog:
+        CATALOG = ShardedCatalog(args.catalog, IMAGE_FOLDER, THUMB_FOLDER)
+    
     if not os.path.exists(IMAGE_FOLDER):
         exit(1)
     
-    if not os.path.exists(THUMB_FOLDER):
-        os.makedirs(THUMB_FOLDER)
-        generate_thumbs()
-    else:
-        images = [f for f in os.listdir(IMAGE_FOLDER) 
-                 if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
-        thumbs = os.listdir(THUMB_FOLDER)
-        
-        if len(thumbs) < len(images) * 0.9:
-            generate_thumbs()
+    os.makedirs(THUMB_FOLDER, exist_ok=True)
+    if args.thumb_store:
+        THUMB_STORE = PackedThumbStore(THUMB_STORE_FOLDER)
+        THUMB_STORE.load()
+        THUMB_STORE.import_folder(THUMB_FOLDER)
+    start_thumb_backfill()
+    
+    CATALOG.refresh()
+    CATALOG.start_watcher()
+    THUMB_PACKS.start_watcher()
+    
+    TAG_INDEX = TagIndex(args.tags_db)
+    TAG_INDEX.refresh()
+    TAG_INDEX.start_watcher()
+    
+    if np is not None:
+        SIMILARITY.start_watcher()
     
     local_ip = get_local_ip()
     
-    with ThreadedTCPServer(("0.0.0.0", PORT), CustomHandler) as httpd:
+    if args.engine == 'asyncio':
         try:
-            httpd.serve_forever()
+            asyncio.run(serve_async("0.0.0.0", PORT))
         except KeyboardInterrupt:
-            pass
\ No newline at end of file
+            pass
+    else:
+        with ThreadedTCPServer(("0.0.0.0", PORT), CustomHandler) as httpd:
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
\ No newline at end of file
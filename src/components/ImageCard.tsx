@@ -83,8 +83,8 @@ export const ImageCard = memo<ImageCardProps & { theme: any }>(
         activeOpacity={0.88}
         onPress={handlePress}
       >
-        <View style={[styles.imageContainer, { height: cardHeight }]}>
-          {imageLoading && (
+        <View style={[styles.imageContainer, { height: cardHeight, backgroundColor: image.color || undefined }]}>
+          {imageLoading && !image.blurhash && (
             <View style={[styles.loadingOverlay, { backgroundColor: theme.overlay }]}>
               <ActivityIndicator size="small" color={theme.accent} />
             </View>
@@ -100,6 +100,7 @@ export const ImageCard = memo<ImageCardProps & { theme: any }>(
           ) : (
             <Image
               source={{ uri: image.thumb || videoThumbnail || image.uri }}
+              placeholder={image.blurhash ? { blurhash: image.blurhash } : undefined}
               style={styles.image}
               contentFit="cover"
               transition={250}
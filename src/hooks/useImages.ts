@@ -1,5 +1,6 @@
 import { useState, useEffect, useCallback, useRef } from 'react';
 import { ImageItem } from '../types/index';
+import { fetchThumbPack, packThumbUri } from '../utils/thumbPack';
 
 const SERVER_IP = '192.168.1.44';
 const SERVER_PORT = 8000;
@@ -61,26 +62,23 @@ export const useImages = () => {
       if (abortControllerRef.current) abortControllerRef.current.abort();
       abortControllerRef.current = new AbortController();
 
-      const response = await fetch(`${SERVER_URL}/api/images?page=${page}`, {
-        signal: abortControllerRef.current.signal,
-        headers: { 'Accept': 'application/json' },
-      });
-
-      if (!response.ok) throw new Error(`HTTP ${response.status}`);
-
-      const data = await response.json();
+      const pack = await fetchThumbPack(SERVER_URL, (page - 1) * PAGE_SIZE, abortControllerRef.current.signal);
 
-      const newItems = data.map((item: any) => ({
+      const newItems = pack.items.map(item => ({
         name: item.name,
         uri: `${SERVER_URL}${item.url}`,
-        thumb: item.thumb ? `${SERVER_URL}${item.thumb}` : null,
+        thumb: packThumbUri(pack, item) || (item.thumb ? `${SERVER_URL}${item.thumb}` : null),
+        preview: item.preview ? `${SERVER_URL}${item.preview}` : null,
         isVideo: item.isVideo || false,
-        size: Math.floor(Math.random() * 5000000) + 1000000,
+        size: item.size ?? undefined,
+        dimensions: item.width && item.height ? { width: item.width, height: item.height } : undefined,
+        color: item.color,
+        blurhash: item.blurhash,
         uploadDate: new Date().toISOString(),
       }));
 
       setImages(prev => isInitial ? newItems : [...prev, ...newItems]);
-      setHasMore(newItems.length === PAGE_SIZE);
+      setHasMore(pack.next !== null);
       setCurrentPage(page);
 
       cacheRef.current = {
@@ -2,9 +2,12 @@ export interface ImageItem {
   name: string;
   uri: string;
   thumb: string | null;
+  preview?: string | null;
   isVideo: boolean;
   size?: number;
   dimensions?: { width: number; height: number };
+  color?: string | null;
+  blurhash?: string | null;
   uploadDate?: string;
   mimeType?: string;
   duration?: number;
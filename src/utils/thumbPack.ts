@@ -0,0 +1,96 @@
+const PACK_MAGIC = 'TPK1';
+const BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/';
+
+export interface PackItem {
+  name: string;
+  url: string;
+  thumb: string | null;
+  preview: string | null;
+  isVideo: boolean;
+  width: number | null;
+  height: number | null;
+  size: number | null;
+  color: string | null;
+  blurhash: string | null;
+  offset: number;
+  length: number;
+}
+
+export interface ThumbPack {
+  cursor: number;
+  next: number | null;
+  items: PackItem[];
+  data: Uint8Array;
+}
+
+const toBase64 = (bytes: Uint8Array): string => {
+  const chunks: string[] = [];
+  let chunk = '';
+  let i = 0;
+  for (; i + 2 < bytes.length; i += 3) {
+    const n = (bytes[i] << 16) | (bytes[i + 1] << 8) | bytes[i + 2];
+    chunk += BASE64[n >> 18] + BASE64[(n >> 12) & 63] + BASE64[(n >> 6) & 63] + BASE64[n & 63];
+    if (chunk.length >= 8192) {
+      chunks.push(chunk);
+      chunk = '';
+    }
+  }
+  const rest = bytes.length - i;
+  if (rest === 1) {
+    const n = bytes[i] << 16;
+    chunk += BASE64[n >> 18] + BASE64[(n >> 12) & 63] + '==';
+  } else if (rest === 2) {
+    const n = (bytes[i] << 16) | (bytes[i + 1] << 8);
+    chunk += BASE64[n >> 18] + BASE64[(n >> 12) & 63] + BASE64[(n >> 6) & 63] + '=';
+  }
+  chunks.push(chunk);
+  return chunks.join('');
+};
+
+const decodeUtf8 = (bytes: Uint8Array): string => {
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 8192) {
+    binary += String.fromCharCode(...bytes.subarray(i, i + 8192));
+  }
+  return decodeURIComponent(escape(binary));
+};
+
+export const parseThumbPack = (buffer: ArrayBuffer): ThumbPack => {
+  const bytes = new Uint8Array(buffer);
+  const magic = String.fromCharCode(...bytes.subarray(0, 4));
+  if (magic !== PACK_MAGIC) throw new Error('Bad thumbnail pack');
+  const headerLength = new DataView(buffer).getUint32(4, true);
+  const header = JSON.parse(decodeUtf8(bytes.subarray(8, 8 + headerLength)));
+  return { ...header, data: bytes.subarray(8 + headerLength) };
+};
+
+export const packThumbUri = (pack: ThumbPack, item: PackItem): string | null => {
+  if (!item.length) return null;
+  return `data:image/jpeg;base64,${toBase64(pack.data.subarray(item.offset, item.offset + item.length))}`;
+};
+
+export const fetchThumbPack = (serverUrl: string, cursor: number, signal?: AbortSignal): Promise<ThumbPack> =>
+  new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open('GET', `${serverUrl}/api/thumbs/pack?cursor=${cursor}`);
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = () => {
+      if (xhr.status !== 200) {
+        reject(new Error(`HTTP ${xhr.status}`));
+        return;
+      }
+      try {
+        resolve(parseThumbPack(xhr.response));
+      } catch (e) {
+        reject(e);
+      }
+    };
+    xhr.onerror = () => reject(new Error('Network error'));
+    xhr.onabort = () => {
+      const err = new Error('Aborted');
+      err.name = 'AbortError';
+      reject(err);
+    };
+    signal?.addEventListener('abort', () => xhr.abort());
+    xhr.send();
+  });
@@ -0,0 +1,75 @@
+import os
+
+import main
+import server
+
+
+def write_catalog(folder, names, shard_size):
+    writer = main.CatalogWriter(str(folder), shard_size=shard_size)
+    for name in names:
+        writer.append(main.catalog_item(name, thumbnailed=True))
+    writer.close()
+
+
+def test_sharded_base_index_matches_lines(tmp_path):
+    names = [f"{i}.jpg" for i in range(1, 24)] + ['odd "name".png', 'back\\slash.gif']
+    write_catalog(tmp_path / "catalog", names, shard_size=5)
+    catalog = server.ShardedCatalog(str(tmp_path / "catalog"), server.IMAGE_FOLDER, server.THUMB_FOLDER,
+                                    meta_path=str(tmp_path / "meta.json"))
+
+    assert catalog.present_ids() == frozenset(range(1, 24))
+    found = catalog.entries_for(['7', '22', 'odd "name"', 'back\\slash', 'missing'])
+    assert [e["name"] for e in found] == ['7.jpg', '22.jpg', 'odd "name".png', 'back\\slash.gif']
+    assert [e["name"] for e in catalog.slice(0, len(names))] == names
+
+
+def test_sharded_base_index_follows_log_appends(tmp_path):
+    folder = tmp_path / "catalog"
+    write_catalog(folder, [f"{i}.jpg" for i in range(1, 8)], shard_size=5)
+    catalog = server.ShardedCatalog(str(folder), server.IMAGE_FOLDER, server.THUMB_FOLDER,
+                                    meta_path=str(tmp_path / "meta.json"))
+    assert catalog.present_ids() == frozenset(range(1, 8))
+
+    write_catalog(folder, [f"{i}.jpg" for i in range(8, 13)], shard_size=5)
+    assert catalog.refresh()
+    assert catalog.present_ids() == frozenset(range(1, 13))
+    assert [e["name"] for e in catalog.entries_for(['3', '9', '12'])] == ['3.jpg', '9.jpg', '12.jpg']
+
+
+def test_unique_page_skips_hidden_without_materialising(tmp_path, monkeypatch):
+    names = [f"{i}.jpg" for i in range(1, 131)]
+    write_catalog(tmp_path / "catalog", names, shard_size=40)
+    catalog = server.ShardedCatalog(str(tmp_path / "catalog"), server.IMAGE_FOLDER, server.THUMB_FOLDER,
+                                    meta_path=str(tmp_path / "meta.json"))
+    hidden = frozenset(str(i) for i in (1, 2, 3, 49, 50, 51, 52, 77, 101, 130, 999))
+    monkeypatch.setattr(server, 'CATALOG', catalog)
+    monkeypatch.setattr(server, 'SEARCH_CACHE', server.ResponseCache(server.SEARCH_CACHE_SIZE))
+    monkeypatch.setattr(server.SIMILARITY, 'hidden', hidden)
+
+    visible = [n for n in names if n.split('.')[0] not in hidden]
+    for page in range(1, 5):
+        got = [e["name"] for e in server.CustomHandler.unique_page(None, page)]
+        assert got == visible[(page - 1) * server.PAGE_SIZE:page * server.PAGE_SIZE]
+
+
+def test_reader_never_loses_entries_during_rotation(tmp_path, monkeypatch):
+    folder = tmp_path / "catalog"
+    catalog = server.ShardedCatalog(str(folder), server.IMAGE_FOLDER, server.THUMB_FOLDER,
+                                    meta_path=str(tmp_path / "meta.json"))
+    seen = []
+    write_manifest = main.CatalogWriter._write_manifest
+
+    def checked_write(writer):
+        catalog.refresh()
+        seen.append((catalog.counts()[0], len(writer.names)))
+        write_manifest(writer)
+        catalog.refresh()
+        seen.append((catalog.counts()[0], len(writer.names)))
+
+    monkeypatch.setattr(main, 'CATALOG_MANIFEST_INTERVAL', 0)
+    monkeypatch.setattr(main.CatalogWriter, '_write_manifest', checked_write)
+    write_catalog(folder, [f"{i}.jpg" for i in range(1, 18)], shard_size=5)
+
+    assert all(shown == written for shown, written in seen)
+    assert [e["name"] for e in catalog.slice(0, 20)] == [f"{i}.jpg" for i in range(1, 18)]
+    assert [n for n in os.listdir(folder) if n.startswith("log")] == ["log-00003.jsonl"]
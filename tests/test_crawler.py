@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import dapi_stub
+import main
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'LIMIT_PER_PAGE', 20)
+    monkeypatch.setattr(main, 'EMPTY_PAGES_LIMIT', 1)
+    monkeypatch.setattr(main, 'random_delay', lambda base: 0)
+    httpd = dapi_stub.make_stub_server(0, posts=45)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def crawler_for(httpd, **options):
+    api_url = f"http://127.0.0.1:{httpd.server_address[1]}/index.php"
+    options.setdefault('workers', 4)
+    options.setdefault('generate_thumbs', False)
+    return main.Crawler(api_url, db_path="crawler.db", rate=1000, burst=100, stats_path="crawler_stats.prom",
+                        **options)
+
+
+def downloaded(job):
+    return sorted(int(name.split('.')[0]) for name in os.listdir(job.folder) if name.endswith('.jpg'))
+
+
+def test_crawl_downloads_all_pages_and_completes(stub):
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub") == (45, None, 3, 1)
+    assert downloaded(job) == list(range(1, 46))
+    assert job.downloaded == 45 and job.failed == 0
+
+
+def test_interrupted_crawl_resumes_from_last_pid(stub):
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.store.save_checkpoint("stub", None, 45, 1, False)
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub") == (45, None, 3, 1)
+    assert downloaded(job) == list(range(1, 26))
+
+
+def test_api_outage_keeps_checkpoint_open_and_rerun_resumes(stub):
+    stub.state.error_from_pid = 1
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub") == (None, 45, 1, 0)
+    assert downloaded(job) == list(range(26, 46))
+
+    stub.state.error_from_pid = None
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub") == (45, None, 3, 1)
+    assert downloaded(job) == list(range(1, 46))
+    assert job.downloaded == 25
+
+
+def test_incremental_crawl_outage_keeps_old_head(stub):
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+
+    stub.state.posts = 60
+    stub.state.error_from_pid = 0
+    with crawler_for(stub) as crawler:
+        crawler.run([main.CrawlJob("stub")])
+        head_id, _, _, completed = crawler.store.checkpoint("stub")
+    assert (head_id, completed) == (45, 1)
+
+    stub.state.error_from_pid = None
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub")[0] == 60
+    assert job.downloaded == 15
+
+
+def test_incremental_crawl_keeps_completed_checkpoint(stub):
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+
+    stub.state.posts = 60
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        saved = []
+        save_checkpoint = crawler.store.save_checkpoint
+        crawler.store.save_checkpoint = lambda *args: saved.append(args) or save_checkpoint(*args)
+        crawler.run([job])
+        assert crawler.store.checkpoint("stub")[0] == 60
+    assert saved and all(args[4] for args in saved)
+    assert job.downloaded == 15
+    assert downloaded(job) == list(range(1, 61))
+
+
+def test_thumbnails_lost_in_a_crash_are_requeued_on_start(stub, monkeypatch):
+    def crashed_dispatch(stage):
+        while stage.queue.get() is not None:
+            pass
+
+    job = main.CrawlJob("stub")
+    with monkeypatch.context() as m:
+        m.setattr(main.ThumbnailStage, '_dispatch', crashed_dispatch)
+        with crawler_for(stub, generate_thumbs=True, thumb_workers=2) as crawler:
+            crawler.run([job])
+            assert len(crawler.store.unthumbnailed_files(job.folder)) == 45
+    assert not os.listdir(job.thumb_folder)
+
+    job = main.CrawlJob("stub")
+    with crawler_for(stub, generate_thumbs=True, thumb_workers=2) as crawler:
+        crawler.run([job])
+        assert crawler.store.unthumbnailed_files(job.folder) == []
+    assert job.downloaded == 0
+    assert sorted(os.listdir(job.thumb_folder)) == sorted(f"{i}.jpg" for i in range(1, 46))
+    items = []
+    for name in os.listdir(job.catalog_dir):
+        if name.endswith('.jsonl'):
+            with open(os.path.join(job.catalog_dir, name), 'r', encoding='utf-8') as f:
+                items += [json.loads(line) for line in f]
+    assert len(items) == 45 and all(item["thumb"] for item in items)
+
+
+def test_throttled_crawl_backs_off_and_finishes(stub):
+    stub.state.throttle_every = 5
+    stub.state.throttle_for = 1
+    stub.state.retry_after = 0
+    job = main.CrawlJob("stub")
+    with crawler_for(stub) as crawler:
+        crawler.run([job])
+        assert crawler.limiter.throttled > 0
+        assert crawler.limiter.limit < crawler.limiter.max_concurrency
+    assert stub.state.throttled > 0
+    assert downloaded(job) == list(range(1, 46))
+
+
+def test_limiter_grows_additively_and_halves_on_throttle():
+    now = [100.0]
+    limiter = main.AdaptiveLimiter(1000, 100, 1, 4, 8, clock=lambda: now[0])
+    for _ in range(4):
+        with limiter.request():
+            pass
+    assert limiter.limit == 5
+
+    with limiter.request() as permit:
+        permit.outcome, permit.retry_after = 'throttled', 2.0
+    assert limiter.limit == 2.5
+    assert limiter.blocked_until == 102.0
+
+    for _ in range(10):
+        limiter.release(False, 'error')
+    assert limiter.limit == 1
+
+
+def test_limiter_token_bucket_waits_for_refill():
+    now = [0.0]
+    limiter = main.AdaptiveLimiter(10, 2, 1, 4, 4, clock=lambda: now[0])
+    limiter.acquire(slot=False)
+    limiter.acquire(slot=False)
+
+    thread = threading.Thread(target=limiter.acquire, args=(False,), daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    now[0] = 0.15
+    with limiter.cond:
+        limiter.cond.notify_all()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert limiter.tokens == pytest.approx(0.5)
+
+
+def test_jobs_share_workers_and_keep_separate_folders(stub):
+    jobs = [main.CrawlJob("stub_a"), main.CrawlJob("stub_b")]
+    with crawler_for(stub, workers=2) as crawler:
+        crawler.run(jobs)
+        for job in jobs:
+            assert crawler.store.checkpoint(job.tag)[3] == 1
+    for job in jobs:
+        assert downloaded(job) == list(range(1, 46))
+
+
+def test_fair_queue_round_robins_between_jobs():
+    queue = main.FairQueue(10)
+    queue.register("a")
+    queue.register("b")
+    for i in range(4):
+        queue.put("a", i)
+    for i in range(2):
+        queue.put("b", i)
+    queue.finish("a")
+    queue.finish("b")
+
+    order = []
+    while (item := queue.get()) is not None:
+        order.append(item)
+    assert order == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2), ("a", 3)]
+
+
+def test_fair_queue_blocks_producer_at_capacity():
+    queue = main.FairQueue(2)
+    queue.register("a")
+    queue.put("a", 0)
+    queue.put("a", 1)
+
+    thread = threading.Thread(target=queue.put, args=("a", 2), daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    assert thread.is_alive()
+
+    assert queue.get() == ("a", 0)
+    thread.join(timeout=1)
+    assert not thread.is_alive()
@@ -0,0 +1,200 @@
+import asyncio
+import http.client
+import os
+import socket
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on {port} did not start")
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(server.IMAGE_FOLDER)
+    os.makedirs(server.THUMB_FOLDER)
+    for i in range(1, 4):
+        Image.new('RGB', (64, 96), (i * 40, 80, 120)).save(os.path.join(server.IMAGE_FOLDER, f"{i}.jpg"))
+        Image.new('RGB', (32, 48), (i * 40, 80, 120)).save(os.path.join(server.THUMB_FOLDER, f"{i}.jpg"))
+    catalog = server.CatalogIndex(server.IMAGE_FOLDER, server.THUMB_FOLDER)
+    monkeypatch.setattr(server, 'CATALOG', catalog)
+    monkeypatch.setattr(server, 'RESPONSE_CACHE', server.ResponseCache())
+    catalog.refresh()
+    return tmp_path
+
+
+@pytest.fixture(params=['threaded', 'asyncio'])
+def base_port(request, library):
+    port = free_port()
+    if request.param == 'threaded':
+        httpd = server.ThreadedTCPServer(("127.0.0.1", port), server.CustomHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        wait_for_port(port)
+        yield port
+        httpd.shutdown()
+        httpd.server_close()
+    else:
+        running = {}
+
+        async def serve():
+            running['loop'] = asyncio.get_running_loop()
+            running['task'] = asyncio.current_task()
+            try:
+                await server.serve_async("127.0.0.1", port)
+            except asyncio.CancelledError:
+                pass
+
+        thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+        thread.start()
+        wait_for_port(port)
+        yield port
+        running['loop'].call_soon_threadsafe(running['task'].cancel)
+        thread.join(timeout=5)
+
+
+@pytest.mark.parametrize('path', ['/', '/api/images?page=1', '/api/stats',
+                                  f'/{server.IMAGE_FOLDER}/1.jpg', f'/{server.THUMB_FOLDER}/2.jpg'])
+def test_head_matches_get_without_body(base_port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+    conn.request('GET', path)
+    get = conn.getresponse()
+    body = get.read()
+    assert get.status == 200
+
+    conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+    conn.request('HEAD', path)
+    head = conn.getresponse()
+    assert head.status == 200
+    assert head.read() == b''
+    assert head.getheader('Content-Type') == get.getheader('Content-Type')
+    assert int(head.getheader('Content-Length')) == len(body)
+
+
+def test_head_leaves_keepalive_connection_usable(base_port):
+    conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+    conn.request('HEAD', f'/{server.THUMB_FOLDER}/1.jpg', headers={'Connection': 'keep-alive'})
+    head = conn.getresponse()
+    head.read()
+    conn.request('GET', '/api/images?page=1', headers={'Connection': 'keep-alive'})
+    get = conn.getresponse()
+    assert get.status == 200
+    assert b'"1.jpg"' in get.read()
+
+
+def test_head_missing_file_is_404(base_port):
+    conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+    conn.request('HEAD', f'/{server.IMAGE_FOLDER}/missing.jpg')
+    assert conn.getresponse().status == 404
+
+
+def test_thumb_pack_prefetch_skips_cached_and_pending(library, monkeypatch):
+    store = server.ThumbPackStore(server.THUMB_PACK_FOLDER)
+    submitted = []
+    monkeypatch.setattr(store.prefetch_pool, 'submit', lambda fn, *args: submitted.append(args))
+
+    store.prefetch(0)
+    store.prefetch(0)
+    assert len(submitted) == 1
+
+    store.prefetching.clear()
+    assert store.get(0) is not None
+    store.prefetch(0)
+    store.prefetch(server.PAGE_SIZE)
+    assert len(submitted) == 1
+
+
+def test_latency_summary_has_sum_and_count():
+    metrics = server.Metrics()
+    for seconds in (0.01, 0.02, 0.03):
+        metrics.begin()
+        metrics.end('images', 200, seconds, 10)
+    lines = metrics.render().splitlines()
+    assert '# TYPE gallery_request_latency_seconds summary' in lines
+    assert 'gallery_request_latency_seconds_sum{route="images"} 0.060000' in lines
+    assert 'gallery_request_latency_seconds_count{route="images"} 3' in lines
+    assert any(line.startswith('gallery_request_latency_seconds{route="images",quantile="0.5"}') for line in lines)
+
+
+def test_tag_index_backs_off_after_db_error(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "crawler.db")
+    with open(db_path, 'wb') as f:
+        f.write(b'not a database' * 100)
+    index = server.TagIndex(db_path)
+    connects = []
+    connect = server.sqlite3.connect
+    monkeypatch.setattr(server.sqlite3, 'connect', lambda *a, **kw: connects.append(a) or connect(*a, **kw))
+
+    for _ in range(5):
+        assert len(index.search(('stub',))) == 0
+    assert len(connects) == 1
+
+    os.remove(db_path)
+    conn = connect(db_path)
+    conn.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, tags TEXT)")
+    conn.execute("INSERT INTO posts VALUES (7, 'stub tag_0')")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(index, '_retry_at', 0.0)
+    assert list(index.search(('stub',))) == [7]
+
+
+def test_thumb_pack_rejects_unaligned_and_out_of_range_cursors(base_port, monkeypatch):
+    store = server.ThumbPackStore(server.THUMB_PACK_FOLDER)
+    monkeypatch.setattr(server, 'THUMB_PACKS', store)
+    statuses = {}
+    for cursor in (0, 7, server.PAGE_SIZE, server.PAGE_SIZE * 1000):
+        conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+        conn.request('GET', f'/api/thumbs/pack?cursor={cursor}')
+        response = conn.getresponse()
+        response.read()
+        statuses[cursor] = response.status
+    assert statuses == {0: 200, 7: 404, server.PAGE_SIZE: 404, server.PAGE_SIZE * 1000: 404}
+    assert len(os.listdir(server.THUMB_PACK_FOLDER)) == 1
+
+
+def test_stored_thumb_range_honours_if_range(base_port, library, monkeypatch):
+    store = server.PackedThumbStore(str(library / server.THUMB_STORE_FOLDER))
+    store.load()
+    old_data = bytes(range(256)) * 4
+    store.put('1.jpg', old_data, mtime=1_600_000_000 * 10**9)
+    monkeypatch.setattr(server, 'THUMB_STORE', store)
+
+    def fetch(headers):
+        conn = http.client.HTTPConnection("127.0.0.1", base_port, timeout=5)
+        conn.request('GET', f'/{server.THUMB_FOLDER}/1.jpg', headers=headers)
+        response = conn.getresponse()
+        return response.status, response.getheader('ETag'), response.read()
+
+    status, old_etag, body = fetch({})
+    assert (status, body) == (200, old_data)
+    old_date = 'Sun, 13 Sep 2020 12:26:40 GMT'
+    assert fetch({'Range': 'bytes=0-9', 'If-Range': old_etag})[::2] == (206, old_data[:10])
+    assert fetch({'Range': 'bytes=0-9', 'If-Range': old_date})[::2] == (206, old_data[:10])
+
+    new_data = b'\xff' * 2000
+    store.put('1.jpg', new_data, mtime=1_700_000_000 * 10**9)
+    assert fetch({'Range': 'bytes=0-9', 'If-Range': old_etag})[::2] == (200, new_data)
+    assert fetch({'Range': 'bytes=0-9', 'If-Range': old_date})[::2] == (200, new_data)
+    assert fetch({'Range': 'bytes=5000-', 'If-Range': old_etag})[::2] == (200, new_data)
+    _, new_etag, _ = fetch({})
+    assert fetch({'Range': 'bytes=0-9', 'If-Range': new_etag})[::2] == (206, new_data[:10])
@@ -0,0 +1,31 @@
+import json
+import os
+
+from PIL import Image
+
+import server
+
+
+def test_overwritten_source_is_rerendered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(server.IMAGE_FOLDER)
+    source = os.path.join(server.IMAGE_FOLDER, "1.jpg")
+    thumb = os.path.join(server.THUMB_FOLDER, "1.jpg")
+    Image.new('RGB', (640, 960), (200, 40, 40)).save(source)
+
+    assert server.generate_thumbs(workers=1) == 1
+    assert server.generate_thumbs(workers=1) == 0
+    with Image.open(thumb) as img:
+        assert img.height > img.width
+
+    folder_mtime = os.stat(server.IMAGE_FOLDER).st_mtime_ns
+    Image.new('RGB', (960, 640), (40, 200, 40)).save(source)
+    assert os.stat(server.IMAGE_FOLDER).st_mtime_ns == folder_mtime
+
+    assert server.generate_thumbs(workers=1) == 1
+    with Image.open(thumb) as img:
+        assert img.width > img.height
+    with open(server.THUMB_META, 'r', encoding='utf-8') as f:
+        meta = json.load(f)["entries"]["1.jpg"]
+    assert (meta["width"], meta["height"]) == (960, 640)
+    assert meta["size"] == os.path.getsize(source)